@@ -1,102 +1,778 @@
 """Collection of functions to scrape various concert calendars"""
 
+import time
+
+# Import of this module starts a cold start
+_module_loaded = time.time()
+
+import hashlib
 import json
 import logging
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import urlparse
 
-import boto3
 import os
 import pymysql
 import re
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 #logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Number of venues fetched at once, and how many of those may hit the same host
+SCRAPER_WORKERS = int(os.environ.get('SCRAPER_WORKERS', 4))
+SCRAPER_MAX_PER_HOST = int(os.environ.get('SCRAPER_MAX_PER_HOST', 2))
+# Seconds to wait for a calendar's server to connect or send data
+SCRAPER_HTTP_TIMEOUT = float(os.environ.get('SCRAPER_HTTP_TIMEOUT', 30))
+# BeautifulSoup tree builder: html.parser, lxml or html5lib
+SCRAPER_PARSER = os.environ.get('SCRAPER_PARSER', 'html.parser')
+# Scrape and parse every calendar and row even when unchanged or not yet due
+SCRAPER_FORCE_PARSE = bool(os.environ.get('SCRAPER_FORCE_PARSE'))
+# Seconds of the invocation kept back for inserting shows once scraping stops
+SCRAPER_RESERVED_TIME = float(os.environ.get('SCRAPER_RESERVED_TIME', 60))
+# Invocations a coordinator splits the due venues over, 0 for one per venue
+SCRAPER_SHARDS = int(os.environ.get('SCRAPER_SHARDS', 0))
+
+
+class RunMetrics(object):
+    """
+    Collects stage durations and counters for one run. Stages and counters
+    recorded inside venue() are attributed to that venue as well, so venue
+    scrapers running in threads each get their own numbers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.start()
+
+    def start(self):
+        """
+        Clear the metrics and restart the run clock
+        """
+        with self._lock:
+            self.started = time.time()
+            self.stages = defaultdict(float)
+            self.counters = defaultdict(int)
+            self.venues = {}
+
+    def _venue(self):
+        name = getattr(self._local, 'venue', None)
+        if name is None:
+            return None
+        return self.venues.setdefault(name, {'seconds': 0.0,
+                                             'stages': defaultdict(float),
+                                             'counters': defaultdict(int)})
+
+    @contextmanager
+    def venue(self, name):
+        """
+        Attribute what this thread records to venue name
+        """
+        self._local.venue = name
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._venue()['seconds'] += time.time() - started
+            self._local.venue = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Add the time spent in the block to stage name
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                self.stages[name] += elapsed
+                venue = self._venue()
+                if venue is not None:
+                    venue['stages'][name] += elapsed
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+            venue = self._venue()
+            if venue is not None:
+                venue['counters'][name] += count
+
+    def record(self):
+        """
+        Returns the run's metrics as a JSON serialisable dict
+        """
+        with self._lock:
+            return {'started': self.started,
+                    'seconds': time.time() - self.started,
+                    'stages': dict(self.stages),
+                    'counters': dict(self.counters),
+                    'venues': dict((name, {'seconds': venue['seconds'],
+                                           'stages': dict(venue['stages']),
+                                           'counters': dict(venue['counters'])})
+                                   for name, venue in self.venues.items())}
+
+    def emit(self, path=None):
+        """
+        Print the run's record as one line of JSON, appending it to path too
+        if given
+        """
+        line = json.dumps(self.record(), sort_keys=True)
+        print(line)
+        if path:
+            with open(path, 'a') as f:
+                f.write(line + '\n')
+
+
+metrics = RunMetrics()
+
+
+# Where the DB creds downloaded from S3 are kept between invocations
+CONFIG_DIR = os.environ.get('RADRADRAD_CONFIG_DIR', '/tmp')
+
+_creds = None
+
 
 def get_creds(bucket='radradrad', key='config.json'):
     """
-    Fetch DB creds from private s3 bucket
+    Fetch DB creds from private s3 bucket.
+    The download is kept in CONFIG_DIR and reused by warm containers.
     """
-    s3client = boto3.client('s3')
-    s3client.download_file(bucket, key, '/tmp/' + key)
-    logger.debug('file downloaded')
-    with open('/tmp/'+key) as f:
-        creds = json.load(f)
+    global _creds
+    if _creds is None:
+        path = os.path.join(CONFIG_DIR, key)
+        if not os.path.isfile(path):
+            import boto3
+            s3client = boto3.client('s3')
+            s3client.download_file(bucket, key, path)
+            logger.debug('file downloaded')
+        with open(path) as f:
+            _creds = json.load(f)
 
-    return creds
+    return _creds
 
-try:
+
+def connect():
     creds = get_creds()
-    db = pymysql.connect(host=creds['host'],
-                         port=3306,
-                         password=creds['password'],
-                         user=creds['username'],
-                         db=creds['db'])
-    cur = db.cursor()
-except:
-    logger.error("Can't connect to DB")
+    return pymysql.connect(host=creds['host'],
+                           port=3306,
+                           password=creds['password'],
+                           user=creds['username'],
+                           db=creds['db'])
+
+
+class Database(object):
+    """
+    Opens the DB connection on first use and keeps it for warm invocations,
+    pinging it first so a connection dropped in between is reopened.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self.conn = None
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = self._connect()
+            return self.conn
+        try:
+            self.conn.ping(reconnect=True)
+        except pymysql.Error:
+            logger.warning('Lost DB connection, reconnecting')
+            self.conn = self._connect()
+        return self.conn
+
+
+database = Database(connect)
+
+
+class ResponseCache(object):
+    """
+    Stores the last body of each calendar url along with its ETag/Last-Modified
+    validators and a hash of the body. Bodies are evicted least recently used
+    first once they take up more than max_bytes.
+
+    Responses passed to store() are only staged. save() writes them to disk
+    and the index, so call it once the scraped shows are committed, and call
+    discard() when they are not: a failed run then refetches everything,
+    even in a process that stays alive for the next run.
+    """
+
+    def __init__(self, path, max_bytes=20 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(path, 'index.json')
+        self._lock = threading.Lock()
+        self._index = None
+        self._pending = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except (IOError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _body_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+
+    def validators(self, url):
+        """
+        Return the conditional request headers for url
+        """
+        with self._lock:
+            entry = self.index.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def body(self, url):
+        """
+        Return the saved body of url, or None
+        """
+        try:
+            with open(self._body_path(url), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def store(self, url, resp):
+        """
+        Stage a response for url until save().
+        Returns False if the page is unchanged since it was last saved.
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if resp.status_code == 304:
+                if entry:
+                    self._pending[url] = (dict(entry, used=time.time()), None)
+                return entry is None
+            digest = hashlib.sha1(resp.content).hexdigest()
+            changed = entry is None or entry['sha1'] != digest
+            self._pending[url] = ({'etag': resp.headers.get('ETag'),
+                                   'last_modified': resp.headers.get('Last-Modified'),
+                                   'sha1': digest,
+                                   'size': len(resp.content),
+                                   'used': time.time()},
+                                  resp.content if changed else None)
+            return changed
+
+    def discard(self):
+        """
+        Drop the responses staged since the last save()
+        """
+        with self._lock:
+            self._pending = {}
+
+    def save(self):
+        """
+        Write the staged responses, evict bodies over max_bytes and write the
+        index to disk
+        """
+        with self._lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            for url, (entry, content) in self._pending.items():
+                if content is not None:
+                    with open(self._body_path(url), 'wb') as f:
+                        f.write(content)
+                self.index[url] = entry
+            self._pending = {}
+            total = sum(entry['size'] for entry in self.index.values())
+            for url, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+                if total <= self.max_bytes:
+                    break
+                total -= entry['size']
+                del self.index[url]
+                try:
+                    os.remove(self._body_path(url))
+                except OSError:
+                    pass
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+
+
+response_cache = ResponseCache(os.environ.get('SCRAPER_CACHE_DIR', '/tmp/radradrad-cache'))
+
+
+class RowFingerprints(object):
+    """
+    Stores a hash of each raw show fragment scraped from each venue's
+    calendar, so rows unchanged since the last run can skip parsing and the
+    database.
+
+    Like ResponseCache, the fingerprints seen this run only replace the
+    stored ones on save(), so call it once the scraped shows are committed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fingerprints = None
+        self._pending = {}
+
+    @property
+    def fingerprints(self):
+        if self._fingerprints is None:
+            try:
+                with open(self.path) as f:
+                    self._fingerprints = json.load(f)
+            except (IOError, ValueError):
+                self._fingerprints = {}
+        return self._fingerprints
+
+    @staticmethod
+    def fingerprint(*parts):
+        return hashlib.sha1(''.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def seen(self, venue):
+        """
+        Return the set of fingerprints stored for venue
+        """
+        with self._lock:
+            return set(self.fingerprints.get(venue, ()))
+
+    def update(self, venue, fingerprints):
+        """
+        Replace venue's fingerprints with those on its calendar this run
+        """
+        with self._lock:
+            self._pending[venue] = sorted(fingerprints)
+
+    def discard(self):
+        """
+        Drop the fingerprints updated since the last save()
+        """
+        with self._lock:
+            self._pending = {}
+
+    def save(self):
+        with self._lock:
+            self.fingerprints.update(self._pending)
+            self._pending = {}
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.fingerprints, f)
+            os.replace(tmp_path, self.path)
+
+
+row_fingerprints = RowFingerprints(os.path.join(response_cache.path, 'fingerprints.json'))
+
+
+class ScrapeScheduler(object):
+    """
+    Decides which venues are due for a scrape.
+
+    Each venue's interval halves (down to its min_interval) when its calendar
+    changed and doubles (up to its max_interval) when it did not, so busy
+    venues are scraped often and quiet ones rarely. Venues are due once 90% of
+    their interval has passed, leaving slack for cron jitter. State is kept
+    in a JSON file and written by save().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._state = None
+
+    @property
+    def state(self):
+        if self._state is None:
+            try:
+                with open(self.path) as f:
+                    self._state = json.load(f)
+            except (IOError, ValueError):
+                self._state = {}
+        return self._state
+
+    def reload(self):
+        """
+        Forget the loaded state, so it is read again on next use
+        """
+        self._state = None
+
+    def due(self, venues, now=None, force=False):
+        """
+        Returns the venues due for a scrape, most overdue first
+        """
+        now = now or time.time()
+        overdue = []
+        for venue in venues:
+            venue_state = self.state.get(venue.name)
+            if venue_state is None or force:
+                overdue.append((float('inf'), venue))
+                continue
+            elapsed = now - venue_state['last_scraped']
+            if elapsed >= venue_state['interval'] * 0.9:
+                overdue.append((elapsed / venue_state['interval'], venue))
+        overdue.sort(key=lambda item: item[0], reverse=True)
+        return [venue for _, venue in overdue]
+
+    def record(self, venue, changed, now=None):
+        """
+        Record a finished scrape of venue and adjust its interval
+        """
+        now = now or time.time()
+        venue_state = self.state.setdefault(venue.name, {'interval': venue.min_interval,
+                                                         'runs': 0,
+                                                         'changes': 0})
+        venue_state['runs'] += 1
+        venue_state['last_scraped'] = now
+        if changed:
+            venue_state['changes'] += 1
+            venue_state['last_changed'] = now
+            venue_state['interval'] = max(venue.min_interval, venue_state['interval'] / 2)
+        else:
+            venue_state['interval'] = min(venue.max_interval, venue_state['interval'] * 2)
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class S3ScrapeScheduler(ScrapeScheduler):
+    """
+    ScrapeScheduler whose state is also kept in S3, since /tmp does not
+    survive a cold start. The state is downloaded on first use after
+    reload(), which the handler calls on every invocation so runs in other
+    containers are not overwritten, and uploaded by save().
+    """
+
+    def __init__(self, path, bucket, key):
+        super(S3ScrapeScheduler, self).__init__(path)
+        self.bucket = bucket
+        self.key = key
+
+    @property
+    def state(self):
+        if self._state is None:
+            import boto3
+            from botocore.exceptions import ClientError
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            try:
+                boto3.client('s3').download_file(self.bucket, self.key, self.path)
+            except ClientError:
+                logger.warning('No schedule in s3://{}/{}, every venue is due'.format(self.bucket, self.key))
+        return ScrapeScheduler.state.fget(self)
+
+    def save(self):
+        super(S3ScrapeScheduler, self).save()
+        import boto3
+        boto3.client('s3').upload_file(self.path, self.bucket, self.key)
+
+
+scheduler = S3ScrapeScheduler(os.path.join(response_cache.path, 'schedule.json'), 'radradrad',
+                              os.environ.get('SCRAPER_SCHEDULE_KEY', 'schedule.json'))
+
+VenueScraper = namedtuple('VenueScraper', 'name url scrape min_interval max_interval')
+
+# Registered venue scrapers by venue name, in registration order
+venue_scrapers = OrderedDict()
+
+
+def venue_scraper(name, url, min_interval=30 * 60, max_interval=24 * 60 * 60):
+    """
+    Register a function as the scraper for a venue's calendar at url.
+    The scheduler scrapes the venue between every min_interval and
+    max_interval seconds depending on how often its calendar changes.
+    """
+    def register(scrape):
+        venue_scrapers[name] = VenueScraper(name, url, scrape, min_interval, max_interval)
+        return scrape
+    return register
+
+session = requests.Session()
+session.headers['User-Agent'] = 'radradrad Concert Calendar v0.1 (radradrad.com)'
+session.mount('http://', HTTPAdapter(pool_maxsize=SCRAPER_WORKERS))
+session.mount('https://', HTTPAdapter(pool_maxsize=SCRAPER_WORKERS))
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def _host_limit(url):
+    """
+    Return the semaphore capping concurrent requests to the host of url
+    """
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(SCRAPER_MAX_PER_HOST)
+        return _host_limits[host]
+
+
+def _make_soup(markup, parse_only=None):
+    """
+    Return soup of markup built with SCRAPER_PARSER.
+    parse_only holds SoupStrainer arguments; html5lib always builds the
+    whole tree, so it is dropped for it. bs4 is imported here so
+    invocations with nothing to scrape never load it.
+    """
+    from bs4 import BeautifulSoup, SoupStrainer
+    if SCRAPER_PARSER == 'html5lib' or parse_only is None:
+        return BeautifulSoup(markup, SCRAPER_PARSER)
+    return BeautifulSoup(markup, SCRAPER_PARSER, parse_only=SoupStrainer(**parse_only))
 
 
-def _get_soup(url):
+def _get_soup(url, parse_only=None):
     """
-    Return soup of calendar
+    Return soup of calendar, or None if it is unchanged since the last run.
+    parse_only limits the tree to what the scraper reads, see _make_soup.
     """
-    headers = {'User-Agent': 'radradrad Concert Calendar v0.1 (radradrad.com)'}
-    resp = requests.get(url, headers=headers)
-    soup = BeautifulSoup(resp.content, 'html.parser')
+    with _host_limit(url), metrics.stage('fetch'):
+        resp = session.get(url, headers=response_cache.validators(url), timeout=SCRAPER_HTTP_TIMEOUT)
+        if resp.status_code == 304 and response_cache.body(url) is None:
+            # Nothing saved to fall back on, so fetch the whole page
+            resp = session.get(url, timeout=SCRAPER_HTTP_TIMEOUT)
+    content = resp.content
+    metrics.add('bytes_fetched', len(content))
+    if resp.status_code in (200, 304) and not response_cache.store(url, resp):
+        metrics.add('calendars_unchanged')
+        if not SCRAPER_FORCE_PARSE:
+            return None
+        content = response_cache.body(url)
+    with metrics.stage('build_tree'):
+        soup = _make_soup(content, parse_only)
     return soup
 
 
-def insert_show(show_info):
+def _date_key(date):
+    """
+    Return a concert date as a YYYY-MM-DD string whatever the column type
+    """
+    return date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else date
+
+
+def fold(text):
     """
-    Insert concert if not in database, else skip it
+    Return text as MySQL's accent and case insensitive collations compare it,
+    ignoring trailing spaces
     """
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower().rstrip()
+
 
-    concert_query = 'SELECT * FROM concert WHERE headliner = %s AND date = %s AND time = %s;'
-    cur.execute(concert_query, (show_info['show_headliner'],
-                                show_info['show_date'],
-                                show_info['show_time']))
+def show_key(headliner, date, time_):
+    """
+    Return the key of concert's unique (date, time, headliner) index
+    """
+    return fold(headliner), _date_key(date), fold(time_)
+
+
+def start_timestamp(date, time=None):
+    """
+    Return the start of a concert on a YYYY-MM-DD date as an integer timestamp.
+    Uses the first clock time in the free text time (e.g. '8:00PM doors'),
+    falling back to the start of the day.
+    """
+    start = datetime.strptime(date, '%Y-%m-%d')
+    match = re.search(r'(\d{1,2})(?::(\d{2}))?\s*([ap])\.?m', time or '', re.IGNORECASE)
+    if match:
+        hour = int(match.group(1)) % 12 + (12 if match.group(3).lower() == 'p' else 0)
+        start = start.replace(hour=hour, minute=int(match.group(2) or 0))
+    return int(start.timestamp())
 
-    concert = cur.fetchall()
 
-    if concert is tuple():
-        venue_id_query = "SELECT id FROM venue WHERE name = %s"
-        cur.execute(venue_id_query, (show_info['show_location'],))
-        logger.debug(show_info['show_location'])
-        venue_id = cur.fetchone()[0]
+def insert_shows(shows):
+    """
+    Insert concerts not already in the database in a single transaction.
+    Returns the list of new shows.
+    """
+    db = database.connection()
+    cur = db.cursor()
+    with metrics.stage('dedupe'):
+        dates = [show_info['show_date'] for show_info in shows if show_info['show_date']]
+        existing = set()
+        if dates:
+            cur.execute('SELECT headliner, date, time FROM concert WHERE date >= %s AND date <= %s',
+                        (min(dates), max(dates)))
+            metrics.add('db_round_trips')
+            existing = set(show_key(headliner, date, time_) for headliner, date, time_ in cur.fetchall())
+        cur.execute('SELECT name, id FROM venue')
+        metrics.add('db_round_trips')
+        venue_ids = dict(cur.fetchall())
         created_at = int(datetime.utcnow().strftime("%s"))
 
-        concert_query = """INSERT INTO concert (created_at, date, time, url, headliner, supports, age, cost, venue_id)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-        try:
-            cur.execute(concert_query, (created_at,
-                                        show_info['show_date'],
-                                        show_info['show_time'],
-                                        show_info['show_url'],
-                                        show_info['show_headliner'],
-                                        ','.join(show_info['show_supports']) if show_info['show_supports'] else None,
-                                        show_info['show_age'],
-                                        show_info['show_cost'],
-                                        venue_id))
-            logger.info('New concert: {}'.format(show_info))
-        except Exception as e:
-            logger.error(e)
-        logger.debug(show_info['show_headliner'])
+        new_shows = []
+        rows = []
+        for show_info in shows:
+            key = show_key(show_info['show_headliner'], show_info['show_date'], show_info['show_time'])
+            if key in existing:
+                continue
+            existing.add(key)
+            new_shows.append(show_info)
+            rows.append((created_at,
+                         show_info['show_date'],
+                         start_timestamp(show_info['show_date'], show_info['show_time']) if show_info['show_date'] else None,
+                         show_info['show_time'],
+                         show_info['show_url'],
+                         show_info['show_headliner'],
+                         ','.join(show_info['show_supports']) if show_info['show_supports'] else None,
+                         show_info['show_age'],
+                         show_info['show_cost'],
+                         venue_ids.get(show_info['show_location'])))
+    metrics.add('shows_new', len(rows))
+    metrics.add('shows_duplicate', len(shows) - len(rows))
+
+    # IGNORE skips a show the unique index still considers a duplicate rather
+    # than rolling back every other new show
+    concert_query = """INSERT IGNORE INTO concert (created_at, date, starts_at, time, url, headliner, supports, age, cost, venue_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+    try:
+        if rows:
+            with metrics.stage('insert'):
+                cur.execute('SELECT COALESCE(MAX(id), 0) FROM concert')
+                last_id = cur.fetchone()[0]
+                cur.executemany(concert_query, rows)
+                # Only the shows that landed are new, IGNORE may have skipped some
+                cur.execute('SELECT id, headliner, date, time FROM concert WHERE id > %s', (last_id,))
+                ids = dict((show_key(headliner, date, time_), concert_id)
+                           for concert_id, headliner, date, time_ in cur.fetchall())
+                inserted = [show_info for show_info in new_shows
+                            if show_key(show_info['show_headliner'], show_info['show_date'],
+                                        show_info['show_time']) in ids]
+                if len(inserted) < len(new_shows):
+                    logger.warning('Skipped {} concerts already in the database'.format(
+                        len(new_shows) - len(inserted)))
+                new_shows = inserted
+                cur.execute('INSERT INTO daily_added (day, count) VALUES (%s, %s) '
+                            'ON DUPLICATE KEY UPDATE count = count + VALUES(count)',
+                            (datetime.utcnow().strftime('%Y-%m-%d'), len(new_shows)))
+                # Invalidates the site's cached pages
+                cur.execute('INSERT INTO data_version (id, version) VALUES (1, 1) '
+                            'ON DUPLICATE KEY UPDATE version = version + 1')
+            metrics.add('db_round_trips', 5)
+            with metrics.stage('link_artists'):
+                link_artists(cur, new_shows, ids)
+            with metrics.stage('search_index'):
+                update_search_index(cur)
+        with metrics.stage('commit'):
+            db.commit()
+        metrics.add('db_round_trips')
+    except Exception:
+        db.rollback()
+        logger.exception('Insert of {} new concerts rolled back'.format(len(rows)))
+        raise
+    for show_info in new_shows:
+        logger.debug('New concert: {}'.format(show_info))
+
+    return new_shows
+
+
+def artist_key(name):
+    return ' '.join(fold(name).split())[:200]
+
+
+def link_artists(cur, new_shows, ids):
+    """
+    Add the headliner and supports of just inserted concerts to the artist
+    and concert_artist tables. ids maps the show_key of each inserted
+    concert to its id.
+    """
+    lineups = []
+    names = {}
+    for show_info in new_shows:
+        concert_id = ids.get(show_key(show_info['show_headliner'], show_info['show_date'], show_info['show_time']))
+        if concert_id is None:
+            continue
+        lineup = [show_info['show_headliner']] + list(show_info['show_supports'] or [])
+        lineup = [name.strip()[:200] if name else None for name in lineup]
+        for name in lineup:
+            if name:
+                names.setdefault(artist_key(name), name)
+        lineups.append((concert_id, lineup))
+    if not names:
+        return
+    cur.executemany('INSERT IGNORE INTO artist (name, `key`) VALUES (%s, %s)',
+                    [(name, key) for key, name in names.items()])
+    cur.execute('SELECT `key`, id FROM artist WHERE `key` IN ({})'.format(', '.join(['%s'] * len(names))),
+                list(names))
+    # Keys come back as stored, which MySQL's collation may match with a
+    # different spelling, so they are keyed again
+    artist_ids = dict((artist_key(key), artist_id) for key, artist_id in cur.fetchall())
+    rows = []
+    for concert_id, lineup in lineups:
+        linked = set()
+        for position, name in enumerate(lineup):
+            artist_id = artist_ids.get(artist_key(name)) if name else None
+            if artist_id is None or artist_id in linked:
+                continue
+            linked.add(artist_id)
+            rows.append((concert_id, position, artist_id))
+    cur.executemany('INSERT IGNORE INTO concert_artist (concert_id, position, artist_id) VALUES (%s, %s, %s)', rows)
+    metrics.add('db_round_trips', 3)
+
 
-        return show_info
+def tokenize(text):
+    """
+    Returns the distinct words of text in order, folded to lower case without
+    accents so words the database collation considers equal are one token
+    """
+    tokens = []
+    for token in re.findall(r'\w+', fold(text)):
+        token = token[:64]
+        if token not in tokens:
+            tokens.append(token)
+    return tokens
 
 
-def notify_email(message):
+def update_search_index(cur):
     """
-    Sends status email with new concerts added to database
+    Add the words of concerts inserted since the last update to the
+    concert_token search index
+    """
+    cur.execute('SELECT id, headliner, supports FROM concert '
+                'WHERE id > (SELECT COALESCE(MAX(concert_id), 0) FROM concert_token)')
+    rows = []
+    for concert_id, headliner, supports in cur.fetchall():
+        # field 0 is the headliner, 1 the supports
+        rows.extend((token, concert_id, 0) for token in tokenize(headliner))
+        rows.extend((token, concert_id, 1) for token in tokenize(supports))
+    metrics.add('db_round_trips')
+    if rows:
+        cur.executemany('INSERT IGNORE INTO concert_token (token, concert_id, field) VALUES (%s, %s, %s)', rows)
+        metrics.add('db_round_trips')
+
+
+def notify_email(new_shows, run_metrics=None):
+    """
+    Sends status email with new concerts added to database and the run's
+    metrics
     """
     topic_arn  = 'arn:aws:sns:us-west-2:609459096019:radradradScraper'
     subject = 'radradradScraper run {}'.format(datetime.utcnow())
-    message = json.dumps(message) if message else 'No new concerts'
+    message = json.dumps({'new_shows': new_shows or 'No new concerts',
+                          'metrics': run_metrics})
+    import boto3
     sns = boto3.client('sns')
     resp = sns.publish(TopicArn=topic_arn,
                        Subject=subject,
@@ -218,16 +894,37 @@ def parse_both(raw_show):
     return show_info
 
 
+def _seen_rows(venue):
+    """
+    Return the fingerprints of venue's rows to skip, none when forced
+    """
+    if SCRAPER_FORCE_PARSE:
+        return set()
+    return row_fingerprints.seen(venue)
+
+
+# Parts of each calendar page the venue scrapers read
+CHAPEL_STRAINER = {'class_': 'vevent'}
+BOTH_STRAINER = {'name': 'table', 'id': 'listings'}
+
+
+@venue_scraper('The Chapel', 'http://www.thechapelsf.com/calendar/')
 def chapel():
     """
     Scrapes calendar information from The Chapel SF website.
+    Returns None if the calendar is unchanged since the last run, and
+    leaves out shows whose markup is unchanged.
     """
     chapel_shows = []
     base_url = 'http://www.thechapelsf.com'
     calendar_url = ''.join([base_url, '/calendar/'])
 
-    soup = _get_soup(calendar_url)
+    soup = _get_soup(calendar_url, parse_only=CHAPEL_STRAINER)
+    if soup is None:
+        return None
 
+    seen = _seen_rows('The Chapel')
+    fingerprints = set()
     show_calendar = soup.findAll(class_='vevent')
     for day in show_calendar:
         show_date = day.find('span', class_='value-title').get('title')
@@ -236,53 +933,266 @@ def chapel():
 
         shows = day.findAll('div', class_='one-event')
         for show in shows:
+            fingerprint = row_fingerprints.fingerprint(show_date, show)
+            fingerprints.add(fingerprint)
+            if fingerprint in seen:
+                metrics.add('shows_unchanged')
+                continue
             logger.debug(show_date)
-            show_info = parse_chapel(show_date, show)
+            metrics.add('shows_parsed')
+            with metrics.stage('parse'):
+                show_info = parse_chapel(show_date, show)
             if show_info.get('show_headliner') and show_info.get('show_headliner') != 'TBA':
                 chapel_shows.append(show_info)
 
+    row_fingerprints.update('The Chapel', fingerprints)
     return chapel_shows
 
 
+@venue_scraper('Bottom of the Hill', 'http://www.bottomofthehill.com/calendar.html')
 def both():
     """
     Scrapes calendar information from Bottom of the Hill website.
+    Returns None if the calendar is unchanged since the last run, and
+    leaves out shows whose markup is unchanged.
     """
 
     both_shows = []
     base_url = 'http://www.bottomofthehill.com'
     calendar_url = ''.join([base_url, '/calendar.html'])
 
-    soup = _get_soup(calendar_url)
+    soup = _get_soup(calendar_url, parse_only=BOTH_STRAINER)
+    if soup is None:
+        return None
 
+    seen = _seen_rows('Bottom of the Hill')
+    fingerprints = set()
     show_calendar = soup.find('table', id='listings').findAll('tr')
     for show in show_calendar:
         if show.find(class_='date'):
-            show_info = parse_both(show)
+            fingerprint = row_fingerprints.fingerprint(show)
+            fingerprints.add(fingerprint)
+            if fingerprint in seen:
+                metrics.add('shows_unchanged')
+                continue
+            metrics.add('shows_parsed')
+            with metrics.stage('parse'):
+                show_info = parse_both(show)
             if show_info.get('show_headliner') and show_info.get('show_headliner') != 'TBA':
                 both_shows.append(show_info)
 
+    row_fingerprints.update('Bottom of the Hill', fingerprints)
     return both_shows
 
 
+# Stands in for the shows of venues skipped for lack of time
+_SKIPPED = object()
+
+
+def scrape_venues(venues, workers=None, budget=None):
+    """
+    Run venue scrapers in a bounded thread pool.
+    Returns an OrderedDict of each venue's shows, in the same order as venues,
+    with None for venues whose calendar is unchanged. Venues not started
+    within budget seconds, and venues whose calendar could not be fetched,
+    are left out so they stay due.
+    """
+    venues = list(venues)
+    workers = workers or SCRAPER_WORKERS
+    started = time.time()
+
+    def scrape(venue):
+        if budget is not None and time.time() - started > budget:
+            metrics.add('venues_skipped')
+            return _SKIPPED
+        with metrics.venue(venue.name):
+            try:
+                return venue.scrape()
+            except requests.RequestException as e:
+                metrics.add('venues_failed')
+                logger.warning('Fetching {} failed: {}'.format(venue.name, e))
+                return _SKIPPED
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(scrape, venues))
+    return OrderedDict((venue.name, venue_shows) for venue, venue_shows in zip(venues, results)
+                       if venue_shows is not _SKIPPED)
+
 
-def main():
+def scrape_and_insert(venues, budget=None):
+    """
+    Scrape venues and insert their new shows.
+    Returns the new shows and an OrderedDict of whether each scraped venue's
+    calendar changed.
+    """
     concerts = []
+    changed = OrderedDict()
+    for name, venue_shows in scrape_venues(venues, budget=budget).items():
+        changed[name] = venue_shows is not None
+        if venue_shows is not None:
+            concerts.extend(venue_shows)
+    logger.info('Scraped {} of {} venues'.format(len(changed), len(venues)))
+    try:
+        new_shows = insert_shows(concerts) if concerts else []
+    except Exception:
+        # Forget this run's calendars so the next run, maybe in this same
+        # container, scrapes and inserts them again
+        response_cache.discard()
+        row_fingerprints.discard()
+        raise
+    with metrics.stage('save_state'):
+        response_cache.save()
+        row_fingerprints.save()
+    return new_shows, changed
+
+
+def record(changed):
+    for name, venue_changed in changed.items():
+        scheduler.record(venue_scrapers[name], changed=venue_changed)
+
+
+def main(budget=None):
+    metrics.start()
+    due = scheduler.due(venue_scrapers.values(), force=SCRAPER_FORCE_PARSE)
+    new_shows, changed = scrape_and_insert(due, budget)
+    record(changed)
+    scheduler.save()
+    run_metrics = metrics.record()
+    logger.info(json.dumps(run_metrics, sort_keys=True))
+    with metrics.stage('notify_email'):
+        notify_email(new_shows, run_metrics)
+
+
+def shard_venues(venues, shards):
+    """
+    Split venues into at most shards lists of names
+    """
+    shards = min(shards, len(venues))
+    return [[venue.name for venue in venues[i::shards]] for i in range(shards)]
+
+
+def lambda_invoker(function_name, deadline):
+    """
+    Returns a function invoking function_name synchronously with an event
+    and returning its decoded result.
+
+    The client waits for a shard until deadline, a time.time() the shards
+    are told to finish by, and never retries, since a retried shard would
+    scrape and insert a second time.
+    """
+    import boto3
+    from botocore.config import Config
+    client = boto3.client('lambda', config=Config(read_timeout=max(1.0, deadline - time.time()),
+                                                  connect_timeout=10,
+                                                  retries={'max_attempts': 0}))
+
+    def invoke(event):
+        resp = client.invoke(FunctionName=function_name,
+                             InvocationType='RequestResponse',
+                             Payload=json.dumps(event).encode('utf-8'))
+        result = json.loads(resp['Payload'].read().decode('utf-8'))
+        if resp.get('FunctionError'):
+            raise RuntimeError('{} failed: {}'.format(function_name, result))
+        return result
+
+    return invoke
+
+
+def coordinate(invoke, shards=None, deadline=None):
+    """
+    Fan the due venues out over shards invocations of invoke and send a
+    single digest of their new shows. Shards are told to finish by deadline,
+    so the coordinator outlives them. A failed shard is logged and its
+    venues stay due.
+    Returns the new shows.
+    """
+    coordinator_metrics = RunMetrics()
+    due = scheduler.due(venue_scrapers.values(), force=SCRAPER_FORCE_PARSE)
+    if not due:
+        notify_email([], coordinator_metrics.record())
+        return []
+    shard_names = shard_venues(due, shards or SCRAPER_SHARDS or len(due))
+
+    def run_shard(names):
+        try:
+            event = {'venues': names}
+            if deadline:
+                event['deadline'] = deadline
+            return invoke(event)
+        except Exception:
+            logger.exception('Shard {} failed'.format(names))
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(shard_names)) as executor:
+        results = list(executor.map(run_shard, shard_names))
     new_shows = []
-    venues = {'The Chapel': chapel,
-              'Bottom of the Hill': both}
-    for venue in venues.values():
-        concerts.extend(venue())
-    for concert in concerts:
-        new_show = insert_show(concert)
-        if new_show:
-            new_shows.append(new_show)
-        db.commit()
-    notify_email(new_shows)
+    shard_metrics = []
+    for names, result in zip(shard_names, results):
+        if result is None:
+            coordinator_metrics.add('shards_failed')
+            continue
+        new_shows.extend(result['new_shows'])
+        record(result['scraped'])
+        shard_metrics.append(dict(result['metrics'], shard=names))
+    scheduler.save()
+    run_metrics = dict(coordinator_metrics.record(), shards=shard_metrics)
+    logger.info(json.dumps(run_metrics, sort_keys=True))
+    notify_email(new_shows, run_metrics)
+    return new_shows
+
+
+_invocations = 0
 
 
 def lambda_handler(event, context):
-    main()
+    """
+    Scrape within the invocation's time limit.
+
+    An event naming {"venues": [...]} scrapes just those venues and returns
+    their new shows without sending email. {"coordinate": true} shards the
+    due venues over invocations of this function, optionally {"shards": n}
+    of them, each given a "deadline" within this invocation's time limit to
+    use as its own. Any other event scrapes every due venue here.
+
+    Returns and logs whether this was a cold start, the seconds spent
+    loading the module on a cold start and the seconds spent scraping.
+    """
+    global _invocations
+    started = time.time()
+    cold_start = _invocations == 0
+    _invocations += 1
+    event = event or {}
+    # Another container may have run and saved the schedule since
+    scheduler.reload()
+    remaining = context.get_remaining_time_in_millis() / 1000.0
+    if event.get('deadline'):
+        remaining = min(remaining, event['deadline'] - time.time())
+    # Keep at most a quarter of a short invocation back, so some venues still get scraped
+    budget = remaining - min(SCRAPER_RESERVED_TIME, remaining / 4)
+    result = {}
+    if event.get('venues'):
+        unknown = [name for name in event['venues'] if name not in venue_scrapers]
+        if unknown:
+            raise ValueError('Unknown venues: {}'.format(', '.join(unknown)))
+        metrics.start()
+        new_shows, changed = scrape_and_insert([venue_scrapers[name] for name in event['venues']], budget)
+        result = {'new_shows': new_shows, 'scraped': changed, 'metrics': metrics.record()}
+        logger.info(json.dumps(result['metrics'], sort_keys=True))
+    elif event.get('coordinate'):
+        # Shards finish with the reserve left for the digest and the schedule
+        deadline = time.time() + budget
+        new_shows = coordinate(lambda_invoker(context.function_name, deadline), event.get('shards'), deadline)
+        result = {'new_shows': len(new_shows)}
+    else:
+        main(budget=budget)
+    timing = {'cold_start': cold_start,
+              'init_seconds': started - _module_loaded if cold_start else 0.0,
+              'run_seconds': time.time() - started}
+    logger.info('{} start: init {init_seconds:.3f}s, run {run_seconds:.3f}s'.format(
+        'Cold' if cold_start else 'Warm', **timing))
+    result.update(timing)
+    return result
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,398 @@
+import importlib.util
+import json
+import shutil
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import os
+import pymysql
+from botocore.exceptions import ClientError
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def load_lambda():
+    """
+    Import lambda.py afresh, as a cold start would
+    """
+    spec = importlib.util.spec_from_file_location('radradrad_lambda', os.path.join(basedir, 'lambda.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeS3(object):
+    """
+    Stands in for the boto3 S3 client holding config.json
+    """
+
+    def __init__(self, creds):
+        self.objects = {'config.json': json.dumps(creds)}
+        self.downloads = 0
+
+    def download_file(self, bucket, key, path):
+        if key not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        self.downloads += 1
+        with open(path, 'w') as f:
+            f.write(self.objects[key])
+
+    def upload_file(self, path, bucket, key):
+        with open(path) as f:
+            self.objects[key] = f.read()
+
+
+class FakeConnection(object):
+    """
+    Stands in for a pymysql connection that may have been dropped
+    """
+
+    def __init__(self):
+        self.dropped = False
+        self.pings = 0
+
+    def ping(self, reconnect=True):
+        self.pings += 1
+        if self.dropped:
+            raise pymysql.err.OperationalError(2013, 'Lost connection to MySQL server')
+
+
+class FakeCursor(object):
+    """
+    Stands in for a pymysql cursor, answering each SELECT with the rows of
+    the first results entry its query starts with
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.statements = []
+        self.rows = []
+
+    def execute(self, query, args=None):
+        self.statements.append((query, args))
+        self.rows = next((rows for prefix, rows in self.results if query.startswith(prefix)), [])
+
+    def executemany(self, query, args):
+        self.statements.append((query, list(args)))
+        return len(args)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeContext(object):
+
+    def __init__(self, remaining=300000):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+class FakeResponse(object):
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {'ETag': '"1"'}
+
+
+class LambdaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.module = load_lambda()
+        self.module.CONFIG_DIR = self.dir
+        self.s3 = FakeS3({'host': 'db', 'username': 'radradrad', 'password': 'secret', 'db': 'radradrad'})
+        self.connections = []
+
+        def connect(**kwargs):
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+
+        patches = [mock.patch('boto3.client', return_value=self.s3),
+                   mock.patch.object(pymysql, 'connect', connect)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_creds_are_downloaded_once(self):
+        self.assertEqual(self.module.get_creds()['host'], 'db')
+        self.module.get_creds()
+        self.assertEqual(self.s3.downloads, 1)
+
+    def test_cold_start_reuses_downloaded_creds(self):
+        self.module.get_creds()
+        module = load_lambda()
+        module.CONFIG_DIR = self.dir
+        self.assertEqual(module.get_creds()['db'], 'radradrad')
+        self.assertEqual(self.s3.downloads, 1)
+
+    def test_connection_is_opened_lazily_and_reused(self):
+        self.assertEqual(self.connections, [])
+        conn = self.module.database.connection()
+        self.assertIs(self.module.database.connection(), conn)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(conn.pings, 1)
+
+    def test_dropped_connection_is_reopened(self):
+        conn = self.module.database.connection()
+        conn.dropped = True
+        self.assertIsNot(self.module.database.connection(), conn)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_handler_reports_cold_then_warm_start(self):
+        with mock.patch.object(self.module, 'main') as main:
+            cold = self.module.lambda_handler({}, FakeContext())
+            warm = self.module.lambda_handler({}, FakeContext())
+        self.assertEqual(main.call_count, 2)
+        self.assertTrue(cold['cold_start'])
+        self.assertGreater(cold['init_seconds'], 0)
+        self.assertFalse(warm['cold_start'])
+        self.assertEqual(warm['init_seconds'], 0)
+
+    def test_short_invocation_still_has_a_budget(self):
+        with mock.patch.object(self.module, 'main') as main:
+            self.module.lambda_handler({}, FakeContext(remaining=30000))
+        self.assertEqual(main.call_args[1]['budget'], 22.5)
+
+    def test_schedule_survives_cold_start(self):
+        self.module.scheduler.path = os.path.join(self.dir, 'schedule.json')
+        venue = self.module.venue_scrapers['The Chapel']
+        self.assertIn(venue, self.module.scheduler.due([venue]))
+        self.module.scheduler.record(venue, changed=True)
+        self.module.scheduler.save()
+        os.unlink(self.module.scheduler.path)
+        module = load_lambda()
+        module.scheduler.path = os.path.join(self.dir, 'schedule.json')
+        self.assertEqual(module.scheduler.due([venue]), [])
+
+    def test_warm_invocation_reloads_the_schedule(self):
+        self.module.scheduler.path = os.path.join(self.dir, 'schedule.json')
+        venue = self.module.venue_scrapers['The Chapel']
+        self.assertEqual(self.module.scheduler.due([venue]), [venue])
+        self.s3.objects['schedule.json'] = json.dumps({'The Chapel': {'interval': 3600, 'runs': 1, 'changes': 1,
+                                                                      'last_scraped': time.time()}})
+        with mock.patch.object(self.module, 'main'):
+            self.module.lambda_handler({}, FakeContext())
+        self.assertEqual(self.module.scheduler.due([venue]), [])
+
+    def test_invoker_waits_for_shards_until_the_deadline_without_retrying(self):
+        with mock.patch('boto3.client') as client:
+            self.module.lambda_invoker('radradrad', time.time() + 300)
+        config = client.call_args[1]['config']
+        self.assertLessEqual(config.read_timeout, 300)
+        self.assertGreater(config.read_timeout, 290)
+        self.assertEqual(config.retries, {'max_attempts': 0})
+
+    def test_shard_uses_the_deadline_as_its_budget(self):
+        with mock.patch.object(self.module, 'scrape_and_insert', return_value=([], {})) as scrape_and_insert:
+            self.module.lambda_handler({'venues': ['The Chapel'], 'deadline': time.time() + 40}, FakeContext())
+        self.assertLessEqual(scrape_and_insert.call_args[0][1], 30)
+
+    def test_heavy_imports_are_deferred(self):
+        self.assertFalse(hasattr(self.module, 'boto3'))
+        self.assertFalse(hasattr(self.module, 'BeautifulSoup'))
+        soup = self.module._make_soup('<table id="listings"><tr><td>x</td></tr></table><p>y</p>',
+                                      self.module.BOTH_STRAINER)
+        self.assertEqual(soup.get_text(), 'x')
+
+
+class InsertShowsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.module = load_lambda()
+        self.cursor = FakeCursor([('SELECT COALESCE(MAX(id), 0) FROM concert', [(0,)]),
+                                  ('SELECT headliner, date, time FROM concert', [('TBA', '2016-08-24', '8:00PM')]),
+                                  ('SELECT name, id FROM venue', [('Bottom of the Hill', 1)]),
+                                  ('SELECT id, headliner, date, time FROM concert',
+                                   [(1, 'TBA', '2016-08-24', '8:00PM'), (2, 'Turnover', '2016-08-24', '8:00PM')]),
+                                  ('SELECT `key`, id FROM artist', [('turnover', 7), ('angel dust', 8)])])
+        self.connection = mock.Mock(**{'cursor.return_value': self.cursor})
+        patch = mock.patch.object(self.module.database, 'connection', return_value=self.connection)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def show(self, headliner):
+        return {'show_date': '2016-08-24',
+                'show_time': '8:00PM',
+                'show_url': 'http://www.bottomofthehill.com/20160824.html',
+                'show_headliner': headliner,
+                'show_supports': ['Angel Dust'],
+                'show_location': 'Bottom of the Hill',
+                'show_age': 'ALL AGES',
+                'show_cost': '$15'}
+
+    def statements(self, prefix):
+        return [args for query, args in self.cursor.statements if query.startswith(prefix)]
+
+    def test_near_duplicates_of_existing_shows_are_skipped(self):
+        new_shows = self.module.insert_shows([self.show('tba '), self.show('Turnover'), self.show('TURNOVER')])
+        self.assertEqual([show['show_headliner'] for show in new_shows], ['Turnover'])
+        inserts = self.statements('INSERT IGNORE INTO concert ')
+        self.assertEqual([row[5] for row in inserts[0]], ['Turnover'])
+        self.assertEqual(self.statements('INSERT INTO daily_added')[0][1], 1)
+        self.assertEqual(self.statements('INSERT IGNORE INTO concert_artist')[0], [(2, 0, 7), (2, 1, 8)])
+        self.connection.commit.assert_called_once_with()
+
+    def test_undated_shows_and_variant_artist_keys_are_linked(self):
+        self.cursor.results[3:] = [('SELECT id, headliner, date, time FROM concert', [(3, 'Turnover', None, None)]),
+                                   ('SELECT `key`, id FROM artist', [('TURNÖVER', 7), ('angel dust', 8)])]
+        undated = dict(self.show('Turnover'), show_date=None, show_time=None)
+        self.assertEqual(self.module.insert_shows([undated]), [undated])
+        self.assertEqual(self.statements('INSERT IGNORE INTO concert_artist')[0], [(3, 0, 7), (3, 1, 8)])
+
+    def test_shows_skipped_by_the_unique_index_are_not_new(self):
+        self.cursor.results[3:] = []
+        self.assertEqual(self.module.insert_shows([self.show('Turnover')]), [])
+        self.assertEqual(self.statements('INSERT INTO daily_added')[0][1], 0)
+        self.assertEqual(self.statements('INSERT IGNORE INTO artist'), [])
+
+    def test_failed_insert_rolls_back(self):
+        self.cursor.executemany = mock.Mock(side_effect=pymysql.err.InternalError(1213, 'Deadlock found'))
+        with self.assertRaises(pymysql.err.InternalError):
+            self.module.insert_shows([self.show('Turnover')])
+        self.connection.rollback.assert_called_once_with()
+        self.connection.commit.assert_not_called()
+
+
+class FanOutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.module = load_lambda()
+        self.module.scheduler = self.module.ScrapeScheduler(os.path.join(self.dir, 'schedule.json'))
+        self.module.venue_scrapers = OrderedDict()
+        for name in ['A', 'B', 'C']:
+            self.module.venue_scraper(name, None)(self.scraper(name))
+        self.invocations = []
+        self.digests = []
+        patches = [mock.patch.object(self.module, 'insert_shows', lambda shows: shows),
+                   mock.patch.object(self.module, 'notify_email',
+                                     lambda new_shows, run_metrics=None: self.digests.append((new_shows, run_metrics))),
+                   mock.patch.object(self.module.response_cache, 'save'),
+                   mock.patch.object(self.module.row_fingerprints, 'save')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scraper(self, name):
+        def scrape():
+            if name == 'C':
+                return None
+            return [{'show_headliner': name}]
+        return scrape
+
+    def invoke(self, event):
+        """
+        Stands in for invoking the function, running the handler in process
+        """
+        self.invocations.append(event)
+        if event['venues'] == ['B'] and self.fail_b:
+            raise RuntimeError('Shard timed out')
+        return json.loads(json.dumps(self.module.lambda_handler(event, FakeContext())))
+
+    def test_event_scrapes_named_venues(self):
+        result = self.module.lambda_handler({'venues': ['A', 'C']}, FakeContext())
+        self.assertEqual(result['new_shows'], [{'show_headliner': 'A'}])
+        self.assertEqual(result['scraped'], {'A': True, 'C': False})
+        self.assertEqual(sorted(result['metrics']['venues']), ['A', 'C'])
+        self.assertEqual(self.digests, [])
+        with self.assertRaises(ValueError):
+            self.module.lambda_handler({'venues': ['Z']}, FakeContext())
+
+    def test_coordinator_merges_shards_into_one_digest(self):
+        self.fail_b = False
+        new_shows = self.module.coordinate(self.invoke)
+        self.assertEqual(sorted(event['venues'] for event in self.invocations), [['A'], ['B'], ['C']])
+        self.assertEqual(sorted(show['show_headliner'] for show in new_shows), ['A', 'B'])
+        self.assertEqual([digest[0] for digest in self.digests], [new_shows])
+        shards = self.digests[0][1]['shards']
+        self.assertEqual(sorted(shard['shard'] for shard in shards), [['A'], ['B'], ['C']])
+        self.assertEqual(sorted(self.module.scheduler.state), ['A', 'B', 'C'])
+
+    def test_coordinator_passes_its_deadline_to_shards(self):
+        self.fail_b = False
+        self.module.coordinate(self.invoke, deadline=time.time() + 100)
+        self.assertTrue(all(event['deadline'] for event in self.invocations))
+
+    def test_failed_shard_stays_due(self):
+        self.fail_b = True
+        new_shows = self.module.coordinate(self.invoke, shards=2)
+        self.assertEqual(sorted(event['venues'] for event in self.invocations), [['A', 'C'], ['B']])
+        self.assertEqual(new_shows, [{'show_headliner': 'A'}])
+        self.assertEqual(self.digests[0][1]['counters'], {'shards_failed': 1})
+        self.assertEqual([venue.name for venue in self.module.scheduler.due(self.module.venue_scrapers.values())],
+                         ['B'])
+
+
+class FailedRunTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.module = load_lambda()
+        self.module.response_cache = self.module.ResponseCache(os.path.join(self.dir, 'cache'))
+        self.module.row_fingerprints = self.module.RowFingerprints(os.path.join(self.dir, 'fingerprints.json'))
+        self.module.venue_scrapers = OrderedDict()
+        self.module.venue_scraper('A', None)(self.scrape)
+        self.inserted = []
+        patch = mock.patch.object(self.module.session, 'get', return_value=FakeResponse(b'<p>A</p>'))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scrape(self):
+        if self.module._get_soup('http://a') is None:
+            return None
+        return [{'show_headliner': 'A'}]
+
+    def insert_shows(self, shows):
+        if self.fail:
+            raise RuntimeError('Deadlock found when trying to get lock')
+        self.inserted.extend(shows)
+        return shows
+
+    def test_warm_run_after_failed_insert_scrapes_again(self):
+        venues = list(self.module.venue_scrapers.values())
+        with mock.patch.object(self.module, 'insert_shows', self.insert_shows):
+            self.fail = True
+            with self.assertRaises(RuntimeError):
+                self.module.scrape_and_insert(venues)
+            self.fail = False
+            new_shows, changed = self.module.scrape_and_insert(venues)
+        self.assertEqual(new_shows, [{'show_headliner': 'A'}])
+        self.assertEqual(self.inserted, new_shows)
+        self.assertEqual(changed, {'A': True})
+
+    def test_failed_insert_discards_row_fingerprints(self):
+        self.module.row_fingerprints.update('A', ['abc'])
+        with mock.patch.object(self.module, 'insert_shows', self.insert_shows):
+            self.fail = True
+            with self.assertRaises(RuntimeError):
+                self.module.scrape_and_insert(list(self.module.venue_scrapers.values()))
+        self.assertEqual(self.module.row_fingerprints._pending, {})
+
+    def test_not_modified_without_saved_body_refetches(self):
+        responses = [FakeResponse(b'', status_code=304), FakeResponse(b'<p>A</p>')]
+        with mock.patch.object(self.module.session, 'get', side_effect=responses) as get:
+            soup = self.module._get_soup('http://a')
+        self.assertEqual(soup.get_text(), 'A')
+        self.assertEqual(get.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
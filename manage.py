@@ -1,12 +1,60 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from radradrad import app, db
+from radradrad import app, db, Concert, DailyAdded, query_plan, uses_index
+from radradrad.publish import publish as publish_pages
+from radradrad.search import rebuild_index, uses_fts
 
 migrate = Migrate(app, db)
 
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def explain():
+    """Check that the listing queries use indexes rather than full scans"""
+    queries = [('date_range', Concert.date_range()),
+               ('venue', Concert.for_venue(1)),
+               ('artist', Concert.for_artist(1)),
+               ('added_today', Concert.added_today())]
+    full_scans = 0
+    for name, query in queries:
+        plan = query_plan(query)
+        if not uses_index(plan):
+            full_scans += 1
+        print('{}: {}'.format(name, 'ok' if uses_index(plan) else 'FULL SCAN'))
+        for step in plan:
+            print('    {}'.format(step))
+    if full_scans:
+        raise SystemExit(1)
+
+
+
+@manager.command
+def rebuild_daily_added():
+    """Recount the concerts added per day from existing rows"""
+    counts = DailyAdded.rebuild()
+    print('Rebuilt {} days, {} concerts'.format(len(counts), sum(counts.values())))
+
+
+@manager.command
+def rebuild_search_index():
+    """Reindex every concert for /search"""
+    count = rebuild_index()
+    print('Indexed {} concerts in {}'.format(count, 'concert_fts' if uses_fts() else 'concert_token'))
+
+
+
+@manager.option('-o', '--output', dest='output_dir', default=app.config['STATIC_SITE_DIR'])
+@manager.option('-f', '--force', dest='force', action='store_true', default=False)
+def publish(output_dir, force):
+    """Pre-render the listing pages into a directory of static files, when the data or the day changed"""
+    if not output_dir:
+        raise SystemExit('Set STATIC_SITE_DIR or pass --output')
+    for filename in publish_pages(output_dir, force=force):
+        print('Wrote {}'.format(filename))
+
+
 if __name__ == '__main__':
     manager.run()
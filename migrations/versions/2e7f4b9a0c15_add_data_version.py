@@ -0,0 +1,27 @@
+"""add data version
+
+Revision ID: 2e7f4b9a0c15
+Revises: 9d4c2a7e61b0
+Create Date: 2026-10-18 11:46:52.092314
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e7f4b9a0c15'
+down_revision = '9d4c2a7e61b0'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    data_version = op.create_table('data_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(data_version, [{'id': 1, 'version': 0}])
+
+
+def downgrade():
+    op.drop_table('data_version')
@@ -0,0 +1,38 @@
+"""add concert search index
+
+Revision ID: 4c8e2b6d1a37
+Revises: 7a0d3c5e9f21
+Create Date: 2026-10-18 16:05:42.118306
+
+Fill with `python manage.py rebuild_search_index`.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c8e2b6d1a37'
+down_revision = '7a0d3c5e9f21'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('concert_token',
+    sa.Column('token', sa.String(length=64), nullable=False),
+    sa.Column('concert_id', sa.Integer(), nullable=False),
+    sa.Column('field', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.ForeignKeyConstraint(['concert_id'], ['concert.id'], ),
+    sa.PrimaryKeyConstraint('token', 'concert_id', 'field')
+    )
+    if op.get_bind().dialect.name == 'sqlite':
+        try:
+            op.execute('CREATE VIRTUAL TABLE concert_fts USING fts5(headliner, supports)')
+        except sa.exc.OperationalError:
+            # No FTS5 in this SQLite, search uses concert_token
+            pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS concert_fts')
+    op.drop_table('concert_token')
@@ -0,0 +1,26 @@
+"""add concert listing indexes
+
+Revision ID: 5b8e1f0c7a3d
+Revises: c5ab2c348934
+Create Date: 2026-10-18 10:12:41.318207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1f0c7a3d'
+down_revision = 'c5ab2c348934'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_concert_date_url', 'concert', ['date', 'url'], unique=False)
+    op.create_index('ix_concert_venue_id_date', 'concert', ['venue_id', 'date'], unique=False)
+    op.create_index('ix_concert_created_at', 'concert', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_concert_created_at', table_name='concert')
+    op.drop_index('ix_concert_venue_id_date', table_name='concert')
+    op.drop_index('ix_concert_date_url', table_name='concert')
@@ -0,0 +1,28 @@
+"""add daily added counts
+
+Revision ID: 7a0d3c5e9f21
+Revises: 2e7f4b9a0c15
+Create Date: 2026-10-18 12:20:09.671445
+
+Backfill with `python manage.py rebuild_daily_added`.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a0d3c5e9f21'
+down_revision = '2e7f4b9a0c15'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('daily_added',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day')
+    )
+
+
+def downgrade():
+    op.drop_table('daily_added')
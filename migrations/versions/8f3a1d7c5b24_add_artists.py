@@ -0,0 +1,80 @@
+"""add artists and concert lineups
+
+Revision ID: 8f3a1d7c5b24
+Revises: 4c8e2b6d1a37
+Create Date: 2026-10-18 17:42:13.507921
+
+Backfills the lineups from the headliner and comma separated supports of
+existing concerts.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f3a1d7c5b24'
+down_revision = '4c8e2b6d1a37'
+
+from alembic import op
+import sqlalchemy as sa
+import unicodedata
+
+BACKFILL_CHUNK = 1000
+
+
+def _key(name):
+    name = unicodedata.normalize('NFKD', name)
+    return ' '.join(''.join(char for char in name if not unicodedata.combining(char)).lower().split())[:200]
+
+
+def upgrade():
+    artist = op.create_table('artist',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=200), nullable=False),
+    sa.Column('key', sa.String(length=200), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('key')
+    )
+    concert_artist = op.create_table('concert_artist',
+    sa.Column('concert_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['artist.id'], ),
+    sa.ForeignKeyConstraint(['concert_id'], ['concert.id'], ),
+    sa.PrimaryKeyConstraint('concert_id', 'position')
+    )
+    op.create_index('ix_concert_artist_artist_id_concert_id', 'concert_artist', ['artist_id', 'concert_id'],
+                    unique=False)
+
+    bind = op.get_bind()
+    concert = sa.table('concert', sa.column('id'), sa.column('headliner'), sa.column('supports'))
+    lineups = []
+    names = {}
+    for concert_id, headliner, supports in bind.execute(sa.select([concert.c.id, concert.c.headliner,
+                                                                   concert.c.supports])):
+        lineup = [headliner] + (supports.split(',') if supports else [])
+        lineup = [name.strip()[:200] if name else None for name in lineup]
+        for name in lineup:
+            if name:
+                names.setdefault(_key(name), name)
+        lineups.append((concert_id, lineup))
+    rows = [{'key': key, 'name': name} for key, name in names.items()]
+    for start in range(0, len(rows), BACKFILL_CHUNK):
+        op.bulk_insert(artist, rows[start:start + BACKFILL_CHUNK])
+    ids = dict(bind.execute(sa.select([artist.c.key, artist.c.id])).fetchall())
+
+    rows = []
+    for concert_id, lineup in lineups:
+        linked = set()
+        for position, name in enumerate(lineup):
+            artist_id = ids.get(_key(name)) if name else None
+            if artist_id is None or artist_id in linked:
+                continue
+            linked.add(artist_id)
+            rows.append({'concert_id': concert_id, 'position': position, 'artist_id': artist_id})
+    for start in range(0, len(rows), BACKFILL_CHUNK):
+        op.bulk_insert(concert_artist, rows[start:start + BACKFILL_CHUNK])
+
+
+def downgrade():
+    op.drop_index('ix_concert_artist_artist_id_concert_id', table_name='concert_artist')
+    op.drop_table('concert_artist')
+    op.drop_table('artist')
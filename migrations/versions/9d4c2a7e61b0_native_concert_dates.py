@@ -0,0 +1,60 @@
+"""native concert dates
+
+Revision ID: 9d4c2a7e61b0
+Revises: 5b8e1f0c7a3d
+Create Date: 2026-10-18 11:02:17.540883
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4c2a7e61b0'
+down_revision = '5b8e1f0c7a3d'
+
+from datetime import datetime
+
+from alembic import op
+import re
+import sqlalchemy as sa
+
+concert = sa.table('concert',
+                   sa.column('id', sa.Integer),
+                   sa.column('date', sa.Date),
+                   sa.column('time', sa.String),
+                   sa.column('starts_at', sa.Integer))
+
+
+def start_timestamp(date, time):
+    """
+    Copy of radradrad.start_timestamp as of this revision
+    """
+    match = re.search(r'(\d{1,2})(?::(\d{2}))?\s*([ap])\.?m', time or '', re.IGNORECASE)
+    hour = minute = 0
+    if match:
+        hour = int(match.group(1)) % 12 + (12 if match.group(3).lower() == 'p' else 0)
+        minute = int(match.group(2) or 0)
+    return int(datetime(date.year, date.month, date.day, hour, minute).timestamp())
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        # SQLite stores DATE as YYYY-MM-DD text, so only strip the time part
+        # DATETIME values carry; a batch type change would CAST them to numbers
+        op.execute('UPDATE concert SET date = substr(date, 1, 10)')
+    else:
+        op.alter_column('concert', 'date', type_=sa.Date(), existing_nullable=True)
+    op.add_column('concert', sa.Column('starts_at', sa.Integer(), nullable=True))
+
+    rows = bind.execute(sa.select([concert.c.id, concert.c.date, concert.c.time])
+                        .where(concert.c.date != None)).fetchall()
+    for concert_id, date, time in rows:
+        bind.execute(concert.update()
+                     .where(concert.c.id == concert_id)
+                     .values(starts_at=start_timestamp(date, time)))
+
+
+def downgrade():
+    with op.batch_alter_table('concert') as batch_op:
+        batch_op.drop_column('starts_at')
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('concert', 'date', type_=sa.String(length=20), existing_nullable=True)
@@ -1,12 +1,19 @@
 import datetime
+import itertools
 import json
 
 import os
-from collections import OrderedDict
-from flask import Flask, render_template
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+from operator import attrgetter
+from flask import Flask, Response, render_template, stream_with_context
 from flask_bootstrap import Bootstrap
-from flask_debugtoolbar import DebugToolbarExtension
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -26,23 +33,68 @@ else:
         'DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'db.sqlite'))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['PAGE_CACHE_MAX_BYTES'] = 16 * 1024 * 1024
+# Search results get their own smaller cache, so arbitrary queries cannot evict listing pages
+app.config['SEARCH_CACHE_MAX_BYTES'] = 1024 * 1024
+# Stream the listing pages as they render instead of building them in memory
+app.config['STREAM_LISTINGS'] = bool(os.environ.get('STREAM_LISTINGS'))
+# Directory the scraper pre-renders the listing pages into, if set
+app.config['STATIC_SITE_DIR'] = os.environ.get('STATIC_SITE_DIR')
+# Directory gunicorn workers share their /metrics numbers through, if set
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+# Bearer token /metrics requires, /metrics is off if unset
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Directory sampled request profiles are written to, profiling is off if unset
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
+# Profile one in this many requests, 0 for only requests asking for it
+app.config['PROFILE_ONE_IN'] = int(os.environ.get('PROFILE_ONE_IN', 0))
+# Requests with this X-Profile header are always profiled
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+app.config['PROFILE_MAX_BYTES'] = int(os.environ.get('PROFILE_MAX_BYTES', 50 * 1024 * 1024))
 # app.config.from_object('config')
 
 db = SQLAlchemy(app)
 Bootstrap(app)
-toolbar = DebugToolbarExtension(app)
+toolbar = None
+if app.debug:
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
 
 
 def timestamp(date=None):
     """
-    Return the current timestamp as an integer
+    Return the current timestamp as an integer,
+    or the timestamp of the start of date (a date or YYYY-MM-DD string)
     :return:
     """
     if date:
-        return int(datetime.datetime.strptime(date, '%Y-%m-%d').timestamp())
+        if isinstance(date, str):
+            date = datetime.datetime.strptime(date, '%Y-%m-%d')
+        return int(datetime.datetime(date.year, date.month, date.day).timestamp())
     return int(datetime.datetime.utcnow().timestamp())
 
 
+def start_timestamp(date, time=None):
+    """
+    Return the start of a concert as an integer timestamp.
+    Uses the first clock time in the free text time (e.g. '8:00PM doors'),
+    falling back to the start of the day.
+    """
+    match = re.search(r'(\d{1,2})(?::(\d{2}))?\s*([ap])\.?m', time or '', re.IGNORECASE)
+    if match is None:
+        return timestamp(date)
+    hour = int(match.group(1)) % 12 + (12 if match.group(3).lower() == 'p' else 0)
+    minute = int(match.group(2) or 0)
+    return int(datetime.datetime(date.year, date.month, date.day, hour, minute).timestamp())
+
+
+def _starts_at_default(context):
+    params = context.get_current_parameters()
+    if params.get('date') is None:
+        return None
+    return start_timestamp(params['date'], params.get('time'))
+
+
 class Venue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True)
@@ -77,13 +129,50 @@ class Venue(db.Model):
                 changed = True
         if changed:
             db.session.commit()
+            venue_registry.invalidate()
+
+
+VenueInfo = namedtuple('VenueInfo', 'id name location')
+
+
+class VenueRegistry(object):
+    """
+    Per-process cache of the venue table, ordered by name.
+    Venues only change when Venue.create_all() adds rows, which invalidates
+    the registry; the ttl covers rows added by other processes.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._venues = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def all(self):
+        with self._lock:
+            if self._venues is None or time.time() - self._loaded_at > self.ttl:
+                query = db.session.query(Venue.id, Venue.name, Venue.location).order_by(Venue.name)
+                self._venues = [VenueInfo(*row) for row in query]
+                self._loaded_at = time.time()
+            return self._venues
+
+    def ids_by_name(self):
+        return {venue.name: venue.id for venue in self.all()}
+
+    def invalidate(self):
+        with self._lock:
+            self._venues = None
+
+
+venue_registry = VenueRegistry()
 
 
 class Concert(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.Integer, default=timestamp)
-    date = db.Column(db.String(20))
+    date = db.Column(db.Date)
     time = db.Column(db.String(80))
+    starts_at = db.Column(db.Integer, default=_starts_at_default)
     url = db.Column(db.String(150))
     headliner = db.Column(db.String(180))
     supports = db.Column(db.Text)
@@ -92,6 +181,9 @@ class Concert(db.Model):
     venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'))
 
     db.UniqueConstraint(date, time, headliner)
+    db.Index('ix_concert_date_url', date, url)
+    db.Index('ix_concert_venue_id_date', venue_id, date)
+    db.Index('ix_concert_created_at', created_at)
 
     def __repr__(self):
         return '<Concert {} - {}>'.format(self.headliner, self.date)
@@ -121,11 +213,33 @@ class Concert(db.Model):
         else:
             date_end = datetime.datetime.strptime(date_end, '%Y-%m-%d')
 
-        concerts = Concert.query.filter(Concert.date >= date_start.strftime('%Y-%m-%d'),
-                                        Concert.date <= date_end.strftime('%Y-%m-%d'),
-                                        Concert.url != None).order_by(Concert.date.asc())
+        concerts = Concert.query.options(db.joinedload(Concert.venue)) \
+            .filter(Concert.date >= date_start.date(),
+                    Concert.date <= date_end.date(),
+                    Concert.url != None) \
+            .order_by(Concert.date.asc(), Concert.starts_at.asc())
         return concerts
 
+    @staticmethod
+    def for_venue(venue_id):
+        """
+        Returns all concerts at a venue
+        """
+        return Concert.query.options(db.joinedload(Concert.venue)) \
+            .filter(Concert.venue_id == venue_id) \
+            .order_by(Concert.date.asc(), Concert.starts_at.asc())
+
+    @staticmethod
+    def for_artist(artist_id, date_start=None):
+        """
+        Returns an artist's concerts from date_start, today by default
+        """
+        date_start = date_start or datetime.datetime.utcnow().date()
+        return Concert.query.options(db.joinedload(Concert.venue)) \
+            .join(ConcertArtist, ConcertArtist.concert_id == Concert.id) \
+            .filter(ConcertArtist.artist_id == artist_id, Concert.date >= date_start) \
+            .order_by(Concert.date.asc(), Concert.starts_at.asc())
+
     @staticmethod
     def added_today(return_dict=False):
         today = datetime.datetime.utcnow()
@@ -134,8 +248,9 @@ class Concert(db.Model):
         # today_timestamp = int(datetime.datetime(today.year, today.month, today.day).timestamp())
         today_timestamp = timestamp('{}-{}-{}'.format(today.year, today.month, today.day))
         tomorrow_timestamp = timestamp('{}-{}-{}'.format(tomorrow.year, tomorrow.month, tomorrow.day))
-        concerts_added_today = Concert.query.filter(Concert.created_at >= today_timestamp,
-                                                    Concert.created_at < tomorrow_timestamp)
+        concerts_added_today = Concert.query.options(db.joinedload(Concert.venue)) \
+            .filter(Concert.created_at >= today_timestamp,
+                    Concert.created_at < tomorrow_timestamp)
 
         if return_dict:
             concerts = concerts_added_today.all()
@@ -148,6 +263,261 @@ class Concert(db.Model):
         concerts = Concert.date_range().all()
         return Concert.concert_to_dict(concerts)
 
+
+class ConcertsByDate(object):
+    """
+    Lazily groups a query ordered by date into (date, concerts) pairs,
+    loading batch_size rows at a time. Stands in for the dict built by
+    Concert.concert_to_dict in streamed templates. lineups holds the
+    ConcertArtist.lineups of the batch being rendered.
+    """
+
+    def __init__(self, query, batch_size=100):
+        self.query = query
+        self.batch_size = batch_size
+        self.lineups = {}
+
+    def items(self):
+        # Each batch is fetched in full so its lineups can be queried
+        # without interrupting an open server side cursor
+        query = self.query.order_by(Concert.id)
+        offset = 0
+        date, day_concerts = None, []
+        while True:
+            batch = query.limit(self.batch_size).offset(offset).all()
+            offset += len(batch)
+            self.lineups.clear()
+            self.lineups.update(ConcertArtist.lineups(day_concerts + batch))
+            for concert in batch:
+                if day_concerts and concert.date != date:
+                    yield date, day_concerts
+                    day_concerts = []
+                date = concert.date
+                day_concerts.append(concert)
+            if len(batch) < self.batch_size:
+                break
+        if day_concerts:
+            yield date, day_concerts
+
+
+class DataVersion(db.Model):
+    """
+    Single row counter bumped whenever the scraper commits new concerts
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def current():
+        version = db.session.query(DataVersion.version).filter(DataVersion.id == 1).scalar()
+        return version or 0
+
+    @staticmethod
+    def bump():
+        """
+        Increment the version in the current transaction
+        """
+        updated = DataVersion.query.filter(DataVersion.id == 1) \
+            .update({DataVersion.version: DataVersion.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(DataVersion(id=1, version=1))
+
+
+class DailyAdded(db.Model):
+    """
+    Number of concerts added per day, kept up to date by the scraper's insert path
+    """
+    day = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def record(count, day=None):
+        """
+        Add count to the day's total in the current transaction
+        """
+        day = day or datetime.datetime.utcnow().date()
+        updated = DailyAdded.query.filter(DailyAdded.day == day) \
+            .update({DailyAdded.count: DailyAdded.count + count}, synchronize_session=False)
+        if not updated:
+            db.session.add(DailyAdded(day=day, count=count))
+
+    @staticmethod
+    def today():
+        day = datetime.datetime.utcnow().date()
+        count = db.session.query(DailyAdded.count).filter(DailyAdded.day == day).scalar()
+        return count or 0
+
+    @staticmethod
+    def rebuild():
+        """
+        Recount every day from the concerts' created_at timestamps
+        """
+        counts = {}
+        for created_at, in db.session.query(Concert.created_at).filter(Concert.created_at != None):
+            day = datetime.datetime.fromtimestamp(created_at).date()
+            counts[day] = counts.get(day, 0) + 1
+        DailyAdded.query.delete()
+        db.session.add_all(DailyAdded(day=day, count=count) for day, count in counts.items())
+        DataVersion.bump()
+        db.session.commit()
+        return counts
+
+
+def fold(text):
+    """
+    Return text as MySQL's accent and case insensitive collations compare it,
+    ignoring trailing spaces
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower().rstrip()
+
+
+class ConcertToken(db.Model):
+    """
+    Inverted index of the words in concert headliners and supports, used for
+    search where SQLite FTS5 is not available. Kept up to date by the
+    scraper's insert path, see radradrad.search.
+    """
+    token = db.Column(db.String(64), primary_key=True)
+    concert_id = db.Column(db.Integer, db.ForeignKey('concert.id'), primary_key=True)
+    # 0 for the headliner, 1 for the supports
+    field = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+
+
+class Artist(db.Model):
+    """
+    A band or performer, matched by name ignoring case, accents and spacing
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    key = db.Column(db.String(200), nullable=False, unique=True)
+
+    def __repr__(self):
+        return '<Artist {}>'.format(self.name)
+
+    @staticmethod
+    def key_for(name):
+        return ' '.join(fold(name).split())[:200]
+
+    @staticmethod
+    def ids_by_key(names):
+        """
+        Returns the ids of the artists named names by key, adding any that
+        are missing in the current transaction
+        """
+        spellings = {}
+        for name in names:
+            if name and name.strip():
+                # The first spelling seen names a new artist
+                spellings.setdefault(Artist.key_for(name), name.strip()[:200])
+        names = spellings
+        if not names:
+            return {}
+        # Keys come back as stored, which MySQL's collation may match with a
+        # different spelling, so they are keyed again
+        ids = dict((Artist.key_for(key), artist_id) for key, artist_id in
+                   db.session.query(Artist.key, Artist.id).filter(Artist.key.in_(names)))
+        missing = [{'key': key, 'name': name} for key, name in names.items() if key not in ids]
+        if missing:
+            db.session.execute(Artist.__table__.insert()
+                               .prefix_with('IGNORE', dialect='mysql')
+                               .prefix_with('OR IGNORE', dialect='sqlite'), missing)
+            ids.update((Artist.key_for(key), artist_id) for key, artist_id in
+                       db.session.query(Artist.key, Artist.id).filter(Artist.key.in_([row['key'] for row in missing])))
+        return ids
+
+
+class ConcertArtist(db.Model):
+    """
+    The artists playing a concert, position 0 the headliner and 1, 2, ...
+    its supports in billing order
+    """
+    concert_id = db.Column(db.Integer, db.ForeignKey('concert.id'), primary_key=True)
+    position = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'), nullable=False)
+
+    db.Index('ix_concert_artist_artist_id_concert_id', artist_id, concert_id)
+
+    @staticmethod
+    def link(lineups):
+        """
+        Add the artists of concerts in the current transaction.
+        lineups maps concert ids to their headliner followed by supports.
+        """
+        ids = Artist.ids_by_key(name for lineup in lineups.values() for name in lineup)
+        rows = []
+        for concert_id, lineup in lineups.items():
+            linked = set()
+            for position, name in enumerate(lineup):
+                artist_id = ids.get(Artist.key_for(name)) if name else None
+                if artist_id is None or artist_id in linked:
+                    continue
+                linked.add(artist_id)
+                rows.append({'concert_id': concert_id, 'position': position, 'artist_id': artist_id})
+        if rows:
+            db.session.execute(ConcertArtist.__table__.insert(), rows)
+        return len(rows)
+
+    @staticmethod
+    def lineups(concerts):
+        """
+        Returns the artist ids of concerts by concert id and position.
+        concerts is a list or a dict of lists by date.
+        """
+        if isinstance(concerts, dict):
+            concerts = [concert for day_concerts in concerts.values() for concert in day_concerts]
+        ids = [concert.id for concert in concerts]
+        if not ids:
+            return {}
+        lineups = {}
+        for concert_id, position, artist_id in db.session.query(
+                ConcertArtist.concert_id, ConcertArtist.position, ConcertArtist.artist_id) \
+                .filter(ConcertArtist.concert_id.in_(ids)):
+            lineups.setdefault(concert_id, {})[position] = artist_id
+        return lineups
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN of a select statement in the current database's dialect
+    """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN ' + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'sqlite')
+def _compile_explain_sqlite(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kw)
+
+
+def query_plan(query):
+    """
+    Returns the query plan of query as a list of dicts, one per step
+    """
+    result = db.session.execute(Explain(query.statement))
+    keys = result.keys()
+    return [dict(zip(keys, row)) for row in result]
+
+
+def uses_index(plan):
+    """
+    Returns False if any step of a SQLite or MySQL query plan is a full table scan
+    """
+    for step in plan:
+        if 'detail' in step:
+            if step['detail'].startswith('SCAN') and 'USING' not in step['detail']:
+                return False
+        elif step.get('type') == 'ALL':
+            return False
+    return True
+
+
 @app.template_filter('timestamp')
 def timestamp_from_date(s):
     return timestamp(s)
@@ -155,28 +525,70 @@ def timestamp_from_date(s):
 
 @app.template_filter('display_date')
 def display_date(s):
-    return datetime.datetime.strptime(s, '%Y-%m-%d').strftime('%A, %B %d, %Y')
+    return s.strftime('%A, %B %d, %Y')
+
+def stream_template(template_name, **context):
+    """
+    Render a template to a streamed response
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(5)
+    return Response(stream_with_context(stream))
+
+
+from radradrad.cache import cached_page
+
 
 @app.route('/')
+@cached_page
 def index():
+    venues = venue_registry.all()
+    added_today = DailyAdded.today()
+    if app.config['STREAM_LISTINGS']:
+        concerts = ConcertsByDate(Concert.date_range())
+        return stream_template('index.html', venues=venues, concerts=concerts, added_today=added_today,
+                               lineups=concerts.lineups)
     concerts = Concert.next_month_by_date()
-    venues = Venue.query.order_by(Venue.name).all()
-    added_today = Concert.added_today().count()
-    return render_template('index.html', venues=venues, concerts=concerts, added_today=added_today)
+    return render_template('index.html', venues=venues, concerts=concerts, added_today=added_today,
+                           lineups=ConcertArtist.lineups(concerts))
 
 
 @app.route('/venue/<int:venue_id>')
+@cached_page
 def venue(venue_id):
-    venues = Venue.query.order_by(Venue.name).all()
-    venue_concerts = Concert.query.filter(Concert.venue_id == venue_id).all()
+    venues = venue_registry.all()
+    added_today = DailyAdded.today()
+    if app.config['STREAM_LISTINGS']:
+        concerts = ConcertsByDate(Concert.for_venue(venue_id))
+        return stream_template('index.html', venues=venues, concerts=concerts, added_today=added_today,
+                               lineups=concerts.lineups)
+    venue_concerts = Concert.for_venue(venue_id).all()
     concerts = Concert.concert_to_dict(venue_concerts)
-    added_today = Concert.added_today().count()
-    return render_template('index.html', venues=venues, concerts=concerts, added_today=added_today)
+    return render_template('index.html', venues=venues, concerts=concerts, added_today=added_today,
+                           lineups=ConcertArtist.lineups(venue_concerts))
+
+
+@app.route('/artist/<int:artist_id>')
+@cached_page
+def artist(artist_id):
+    artist = Artist.query.get_or_404(artist_id)
+    venues = venue_registry.all()
+    added_today = DailyAdded.today()
+    artist_concerts = Concert.for_artist(artist_id).all()
+    concerts = Concert.concert_to_dict(artist_concerts)
+    return render_template('index.html', venues=venues, concerts=concerts, added_today=added_today,
+                           artist=artist, lineups=ConcertArtist.lineups(artist_concerts))
 
 
 @app.route('/new')
+@cached_page
 def new():
-    venues = Venue.query.order_by(Venue.name).all()
+    venues = venue_registry.all()
     concerts_today = Concert.added_today(True)
-    added_today = Concert.added_today().count()
-    return render_template('index.html', venues=venues, concerts=concerts_today, added_today=added_today)
+    added_today = DailyAdded.today()
+    return render_template('index.html', venues=venues, concerts=concerts_today, added_today=added_today,
+                           lineups=ConcertArtist.lineups(concerts_today))
+
+
+from radradrad import api, metrics, profiler, search
@@ -0,0 +1,102 @@
+"""Read-only JSON API"""
+
+import base64
+import datetime
+import json
+
+from flask import Response, jsonify, request, stream_with_context
+from sqlalchemy import and_, or_
+
+from radradrad import app, venue_registry, Concert
+
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 500
+
+
+def encode_cursor(concert):
+    """
+    Returns an opaque cursor pointing just past concert in (date, id) order
+    """
+    raw = '{}:{}'.format(concert.date.isoformat(), concert.id)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (date, id) pair of a cursor, raising ValueError if it is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        date, concert_id = raw.split(':')
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date(), int(concert_id)
+    except ValueError:
+        raise ValueError('invalid cursor')
+
+
+def concert_json(concert):
+    return {'id': concert.id,
+            'date': concert.date.isoformat(),
+            'time': concert.time,
+            'starts_at': concert.starts_at,
+            'created_at': concert.created_at,
+            'url': concert.url,
+            'headliner': concert.headliner,
+            'supports': concert.supports.split(',') if concert.supports else [],
+            'age': concert.age,
+            'cost': concert.cost,
+            'venue': {'id': concert.venue_id,
+                      'name': concert.venue.name if concert.venue else None}}
+
+
+def _bad_request(message):
+    response = jsonify(error=message)
+    response.status_code = 400
+    return response
+
+
+@app.route('/api/concerts')
+def api_concerts():
+    """
+    Concerts ordered by (date, id), a page at a time.
+
+    Takes start and end dates (YYYY-MM-DD, defaulting to the next four weeks),
+    venue (id), since (created_at timestamp), limit and the cursor returned
+    as "next" by the previous page.
+    """
+    args = request.args
+    try:
+        query = Concert.date_range(args.get('start'), args.get('end'))
+        limit = min(int(args.get('limit', API_DEFAULT_LIMIT)), API_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        if 'venue' in args:
+            venue_id = int(args['venue'])
+            if venue_id not in [venue.id for venue in venue_registry.all()]:
+                raise ValueError('unknown venue {}'.format(venue_id))
+            query = query.filter(Concert.venue_id == venue_id)
+        if 'since' in args:
+            query = query.filter(Concert.created_at >= int(args['since']))
+        if 'cursor' in args:
+            cursor_date, cursor_id = decode_cursor(args['cursor'])
+            query = query.filter(or_(Concert.date > cursor_date,
+                                     and_(Concert.date == cursor_date, Concert.id > cursor_id)))
+    except ValueError as e:
+        return _bad_request(str(e))
+
+    # One extra row tells whether there is a next page
+    query = query.order_by(None).order_by(Concert.date.asc(), Concert.id.asc()).limit(limit + 1)
+
+    def generate():
+        yield '{"concerts": ['
+        last = None
+        for count, concert in enumerate(query.yield_per(API_DEFAULT_LIMIT)):
+            if count == limit:
+                yield '], "next": {}}}'.format(json.dumps(encode_cursor(last)))
+                return
+            if last is not None:
+                yield ', '
+            yield json.dumps(concert_json(concert))
+            last = concert
+        yield '], "next": null}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
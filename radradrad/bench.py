@@ -0,0 +1,165 @@
+"""Load benchmark for the listing routes
+
+Seeds a synthetic SQLite database and drives the routes through the Flask
+test client, e.g. `python -m radradrad.bench --concerts 100000 --venues 50`.
+Reports latency percentiles, SQL queries and ORM rows hydrated per request.
+"""
+
+import argparse
+import datetime
+import json
+import random
+import time
+
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from radradrad import app, db, timestamp, venue_registry, Concert, DailyAdded, DataVersion, Venue
+from radradrad.cache import page_cache
+
+SEED_CHUNK = 10000
+
+
+def seed(concerts, venues, days_ahead=60):
+    """
+    Drop and refill the configured database with venues and concerts.
+    Concerts are spread evenly from years back up to days_ahead from today,
+    one in a hundred of them added today.
+    """
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Venue.__table__.insert(),
+                       [{'name': 'Venue {}'.format(i), 'location': 'sf'} for i in range(venues)])
+    random.seed(0)
+    today = datetime.datetime.utcnow().date()
+    yesterday = today - datetime.timedelta(1)
+    days = max(concerts // (venues * 2), days_ahead + 1)
+    first_day = today + datetime.timedelta(days_ahead - days)
+    added_today = 0
+    for start in range(0, concerts, SEED_CHUNK):
+        rows = []
+        for i in range(start, min(start + SEED_CHUNK, concerts)):
+            date = first_day + datetime.timedelta(i * days // concerts)
+            created_at = timestamp(min(date, yesterday))
+            if i % 100 == 0:
+                created_at = timestamp(today)
+                added_today += 1
+            rows.append({'date': date,
+                         'time': '8:00PM',
+                         'starts_at': timestamp(date) + 20 * 3600,
+                         'created_at': created_at,
+                         'url': 'http://www.example.com/{}'.format(i),
+                         'headliner': 'Headliner {}'.format(i),
+                         'supports': 'Support {0}a,Support {0}b'.format(i),
+                         'age': 'All Ages',
+                         'cost': '$10',
+                         'venue_id': random.randint(1, venues)})
+        db.session.execute(Concert.__table__.insert(), rows)
+    DailyAdded.record(added_today)
+    DataVersion.bump()
+    db.session.commit()
+    venue_registry.invalidate()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class RequestCounter(object):
+    """
+    Counts SQL statements and ORM instances loaded while active
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.active = False
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        for model in (Concert, Venue):
+            event.listen(model, 'load', self._load)
+
+    def _before_cursor_execute(self, *args):
+        if self.active:
+            self.queries += 1
+
+    def _load(self, *args):
+        if self.active:
+            self.rows += 1
+
+    def remove(self):
+        event.remove(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        for model in (Concert, Venue):
+            event.remove(model, 'load', self._load)
+
+
+def run(paths, requests, use_cache=False):
+    """
+    Request each path requests times after one warm up request.
+    Returns per path latency percentiles in milliseconds and the average
+    queries and rows hydrated per request.
+    """
+    client = app.test_client()
+    counter = RequestCounter()
+    results = {}
+    try:
+        for path in paths:
+            # Warm up the venue registry and template cache
+            client.get(path).get_data()
+            latencies = []
+            counter.queries = counter.rows = 0
+            for _ in range(requests):
+                if not use_cache:
+                    page_cache.clear()
+                counter.active = True
+                started = time.perf_counter()
+                resp = client.get(path)
+                resp.get_data()
+                latencies.append((time.perf_counter() - started) * 1000)
+                counter.active = False
+                if resp.status_code != 200:
+                    raise RuntimeError('{} returned {}'.format(path, resp.status_code))
+            results[path] = {'p50_ms': percentile(latencies, 50),
+                             'p95_ms': percentile(latencies, 95),
+                             'p99_ms': percentile(latencies, 99),
+                             'queries_per_request': counter.queries / float(requests),
+                             'rows_per_request': counter.rows / float(requests)}
+    finally:
+        counter.remove()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='/tmp/radradrad-bench.sqlite', help='SQLite file to use')
+    parser.add_argument('--concerts', type=int, default=10000)
+    parser.add_argument('--venues', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=50, help='requests per route')
+    parser.add_argument('--reuse', action='store_true', help='skip seeding an existing database')
+    parser.add_argument('--cache', action='store_true', help='leave the page cache on between requests')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(args.database)
+    if not (args.reuse and os.path.isfile(args.database)):
+        started = time.perf_counter()
+        seed(args.concerts, args.venues)
+        print('Seeded {} concerts at {} venues in {:.1f}s'.format(
+            args.concerts, args.venues, time.perf_counter() - started))
+
+    paths = ['/', '/venue/1', '/new', '/api/concerts']
+    results = run(paths, args.requests, args.cache)
+    print('{:16} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('route', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'rows'))
+    for path in paths:
+        result = results[path]
+        print('{:16} {p50_ms:9.1f} {p95_ms:9.1f} {p99_ms:9.1f} {queries_per_request:9.1f} '
+              '{rows_per_request:9.1f}'.format(path, **result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
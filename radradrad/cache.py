@@ -0,0 +1,89 @@
+"""Full-page cache for the listing routes"""
+
+import datetime
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+from radradrad import app, DataVersion
+
+
+class PageCache(object):
+    """
+    In-process LRU cache of rendered pages capped at max_bytes of page bodies.
+
+    Each gunicorn worker keeps its own cache. Keys include the data version
+    stored in the database, so a scrape in any process invalidates every
+    worker's pages on their next request.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, body, etag):
+        with self._lock:
+            if key in self._pages:
+                self.size -= len(self._pages.pop(key)[0])
+            if len(body) > self.max_bytes:
+                return
+            self._pages[key] = (body, etag)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (old_body, _) = self._pages.popitem(last=False)
+                self.size -= len(old_body)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.size = 0
+
+
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+
+
+def cached_page(view=None, cache=None):
+    """
+    Serve a view from the page cache, or cache if given, with a strong ETag,
+    answering If-None-Match with 304.
+    Pages are keyed by route, arguments, data version and the current day,
+    since "added today" and the four week window move at midnight.
+    Streamed responses are passed through uncached.
+    """
+    if view is None:
+        return functools.partial(cached_page, cache=cache)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        pages = cache or page_cache
+        key = (request.endpoint,
+               tuple(sorted(kwargs.items())),
+               request.query_string,
+               DataVersion.current(),
+               datetime.datetime.utcnow().date())
+        page = pages.get(key)
+        if page is None:
+            rv = view(*args, **kwargs)
+            if isinstance(rv, Response):
+                return rv
+            body = rv.encode('utf-8')
+            etag = hashlib.sha1(body).hexdigest()
+            pages.set(key, body, etag)
+        else:
+            body, etag = page
+        response = Response(body, mimetype='text/html')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    return wrapper
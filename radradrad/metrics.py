@@ -0,0 +1,224 @@
+"""Per-route request metrics in Prometheus text format
+
+Each request's latency, SQL query count and SQL time are recorded against
+its endpoint. Under gunicorn every worker keeps its own numbers, so each
+worker also writes them to <METRICS_DIR>/<pid>.json and /metrics adds up
+the files of all workers. Without METRICS_DIR only the serving process is
+reported.
+
+/metrics is only served when METRICS_TOKEN is set, to requests sending it
+as a bearer token (bearer_token in a Prometheus scrape config).
+"""
+
+import json
+import threading
+import time
+
+import os
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from radradrad import app
+
+# Upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds between writes of a worker's metrics to METRICS_DIR
+FLUSH_INTERVAL = 1.0
+
+
+class RouteMetrics(object):
+    """
+    Latency histograms and SQL totals by endpoint for this process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer = None
+        self.routes = {}
+        self.flushed = 0
+
+    def observe(self, endpoint, status, seconds, queries, query_seconds):
+        with self._lock:
+            route = self.routes.setdefault(endpoint, {'buckets': [0] * len(BUCKETS),
+                                                      'count': 0,
+                                                      'sum': 0.0,
+                                                      'queries': 0,
+                                                      'query_seconds': 0.0,
+                                                      'statuses': {}})
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    route['buckets'][i] += 1
+            route['count'] += 1
+            route['sum'] += seconds
+            route['queries'] += queries
+            route['query_seconds'] += query_seconds
+            status = str(status)
+            route['statuses'][status] = route['statuses'].get(status, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.routes))
+
+    def flush(self, directory, force=False):
+        """
+        Write this process's metrics to directory, at most once per
+        FLUSH_INTERVAL unless forced. A write held back by the interval is
+        made by a timer once it has passed, so the last requests of a worker
+        that then goes idle still reach directory.
+        """
+        with self._flush_lock:
+            wait = self.flushed + FLUSH_INTERVAL - time.time()
+            if not force and wait > 0:
+                if self._flush_timer is None:
+                    self._flush_timer = threading.Timer(wait, self._flush_later, (directory,))
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return
+            self.flushed = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '{}.json'.format(os.getpid()))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def _flush_later(self, directory):
+        with self._flush_lock:
+            self._flush_timer = None
+        self.flush(directory, force=True)
+
+
+route_metrics = RouteMetrics()
+
+
+def merge(snapshots):
+    """
+    Add up the route metrics of several processes
+    """
+    merged = {}
+    for routes in snapshots:
+        for endpoint, route in routes.items():
+            total = merged.setdefault(endpoint, {'buckets': [0] * len(BUCKETS),
+                                                 'count': 0,
+                                                 'sum': 0.0,
+                                                 'queries': 0,
+                                                 'query_seconds': 0.0,
+                                                 'statuses': {}})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], route['buckets'])]
+            for key in ('count', 'sum', 'queries', 'query_seconds'):
+                total[key] += route[key]
+            for status, count in route['statuses'].items():
+                total['statuses'][status] = total['statuses'].get(status, 0) + count
+    return merged
+
+
+def collect(directory=None):
+    """
+    Returns the route metrics of every worker writing to directory, or of
+    this process alone
+    """
+    if not directory:
+        return route_metrics.snapshot()
+    route_metrics.flush(directory, force=True)
+    snapshots = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshots.append(json.load(f))
+        except (IOError, ValueError):
+            continue
+    return merge(snapshots)
+
+
+def _format_bound(bound):
+    return '{:g}'.format(bound)
+
+
+def render(routes):
+    """
+    Returns routes in the Prometheus text exposition format
+    """
+    lines = ['# HELP radradrad_request_duration_seconds Request latency by route.',
+             '# TYPE radradrad_request_duration_seconds histogram']
+    for endpoint, route in sorted(routes.items()):
+        for bound, count in zip(BUCKETS, route['buckets']):
+            lines.append('radradrad_request_duration_seconds_bucket{{route="{}",le="{}"}} {}'.format(
+                endpoint, _format_bound(bound), count))
+        lines.append('radradrad_request_duration_seconds_bucket{{route="{}",le="+Inf"}} {}'.format(
+            endpoint, route['count']))
+        lines.append('radradrad_request_duration_seconds_sum{{route="{}"}} {}'.format(endpoint, route['sum']))
+        lines.append('radradrad_request_duration_seconds_count{{route="{}"}} {}'.format(endpoint, route['count']))
+    lines += ['# HELP radradrad_requests_total Requests by route and status.',
+              '# TYPE radradrad_requests_total counter']
+    for endpoint, route in sorted(routes.items()):
+        for status, count in sorted(route['statuses'].items()):
+            lines.append('radradrad_requests_total{{route="{}",status="{}"}} {}'.format(endpoint, status, count))
+    lines += ['# HELP radradrad_sql_queries_total SQL queries run by route.',
+              '# TYPE radradrad_sql_queries_total counter']
+    for endpoint, route in sorted(routes.items()):
+        lines.append('radradrad_sql_queries_total{{route="{}"}} {}'.format(endpoint, route['queries']))
+    lines += ['# HELP radradrad_sql_query_seconds_total Time spent in SQL queries by route.',
+              '# TYPE radradrad_sql_query_seconds_total counter']
+    for endpoint, route in sorted(routes.items()):
+        lines.append('radradrad_sql_query_seconds_total{{route="{}"}} {}'.format(endpoint, route['query_seconds']))
+    return '\n'.join(lines) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'metrics_started' in g:
+        conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_query_started')
+    if started and has_request_context() and 'metrics_started' in g:
+        g.metrics_queries += 1
+        g.metrics_query_seconds += time.perf_counter() - started.pop()
+
+
+@app.before_request
+def _start_request_metrics():
+    if request.endpoint in (None, 'static', 'metrics'):
+        return
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_query_seconds = 0.0
+
+
+@app.after_request
+def _record_request_metrics(response):
+    """
+    Record the request once its response is closed, so streamed pages
+    include the queries run while they render
+    """
+    if 'metrics_started' not in g:
+        return response
+    request_g = g._get_current_object()
+    endpoint = request.endpoint
+    status = response.status_code
+
+    def record():
+        route_metrics.observe(endpoint, status, time.perf_counter() - request_g.metrics_started,
+                              request_g.metrics_queries, request_g.metrics_query_seconds)
+        if app.config['METRICS_DIR']:
+            route_metrics.flush(app.config['METRICS_DIR'])
+
+    response.call_on_close(record)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if not token or request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(404)
+    return Response(render(collect(app.config['METRICS_DIR'])),
+                    mimetype='text/plain; version=0.0.4')
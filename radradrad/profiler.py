@@ -0,0 +1,116 @@
+"""Opt-in sampling request profiler
+
+Set PROFILE_DIR to profile one in every PROFILE_ONE_IN requests, and any
+request whose X-Profile header matches PROFILE_TOKEN. Each profiled request
+leaves a cProfile dump, readable with pstats, and a JSON file of its route,
+arguments and SQL statements. The oldest dumps are removed once the
+directory holds more than PROFILE_MAX_BYTES.
+"""
+
+import cProfile
+import itertools
+import json
+import threading
+import time
+
+import os
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from radradrad import app
+
+_requests = itertools.count(1)
+_dumps = itertools.count(1)
+_dump_lock = threading.Lock()
+
+
+def _should_profile():
+    token = app.config['PROFILE_TOKEN']
+    if token and request.headers.get('X-Profile') == token:
+        return True
+    one_in = app.config['PROFILE_ONE_IN']
+    return bool(one_in) and next(_requests) % one_in == 0
+
+
+def _dump_name(endpoint):
+    return '{}-{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), endpoint, os.getpid(), next(_dumps))
+
+
+def rotate(directory, max_bytes):
+    """
+    Remove the oldest dumps in directory until it holds at most max_bytes
+    """
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    files = sorted((os.stat(path).st_mtime, path) for path in paths if os.path.isfile(path))
+    total = sum(os.path.getsize(path) for _, path in files)
+    for _, path in files:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(path)
+        os.remove(path)
+
+
+def dump(directory, profile, info):
+    """
+    Write profile and info about its request to directory.
+    Returns the path of the profile dump.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, _dump_name(info['endpoint']))
+    profile.dump_stats(path + '.prof')
+    with open(path + '.json', 'w') as f:
+        json.dump(info, f, indent=2, default=str)
+    with _dump_lock:
+        rotate(directory, app.config['PROFILE_MAX_BYTES'])
+    return path + '.prof'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g:
+        conn.info.setdefault('profile_query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profile_query_started')
+    if started and has_request_context() and 'profile' in g:
+        g.profile_statements.append({'statement': statement,
+                                     'parameters': parameters,
+                                     'seconds': time.perf_counter() - started.pop()})
+
+
+@app.before_request
+def _start_profile():
+    if not app.config['PROFILE_DIR'] or request.endpoint in (None, 'static') or not _should_profile():
+        return
+    g.profile_statements = []
+    g.profile_started = time.perf_counter()
+    g.profile = cProfile.Profile()
+    g.profile.enable()
+
+
+@app.after_request
+def _dump_profile(response):
+    """
+    Stop profiling once the response is closed, so streamed pages are
+    profiled while they render
+    """
+    if 'profile' not in g:
+        return response
+    request_g = g._get_current_object()
+    info = {'endpoint': request.endpoint,
+            'view_args': request.view_args,
+            'path': request.path,
+            'query_string': request.query_string.decode('utf-8', 'replace'),
+            'status': response.status_code}
+
+    def finish():
+        request_g.profile.disable()
+        info['seconds'] = time.perf_counter() - request_g.profile_started
+        info['statements'] = request_g.profile_statements
+        dump(app.config['PROFILE_DIR'], request_g.profile, info)
+
+    response.call_on_close(finish)
+    return response
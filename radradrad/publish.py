@@ -0,0 +1,91 @@
+"""Pre-render the listing pages to static files after each scrape
+
+The files mirror the site's urls, so nginx can serve them before falling
+back to gunicorn, e.g.:
+
+    location / {
+        root /var/www/radradrad;
+        try_files $uri $uri/index.html @gunicorn;
+    }
+
+The pages show the next four weeks and the concerts added today, so they
+also go stale at midnight (UTC), and the Lambda scraper cannot publish
+them at all. Run manage.py publish from cron as well, e.g. every 10
+minutes:
+
+    */10 * * * * cd /srv/radradrad && python manage.py publish
+
+It only renders the pages when the data version or the day has changed
+since the last publish.
+"""
+
+import datetime
+import tempfile
+
+import os
+from flask import url_for
+
+from radradrad import app, venue_registry, DataVersion
+
+# Records the data version and day the pages were last rendered for
+STAMP_FILE = '.published'
+
+
+def page_paths():
+    """
+    Returns the url of every listing page
+    """
+    paths = ['/', '/new']
+    with app.test_request_context():
+        paths.extend(url_for('venue', venue_id=venue.id) for venue in venue_registry.all())
+    return paths
+
+
+def _write_if_changed(filename, body):
+    """
+    Atomically replace filename with body unless it already holds body
+    """
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == body:
+                return False
+    except IOError:
+        pass
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, filename)
+    return True
+
+
+def publish(output_dir, force=False):
+    """
+    Render the listing pages into output_dir, rewriting only pages whose
+    content changed. Unless forced, nothing is rendered when the data
+    version and day are those of the last publish.
+    Returns the list of files written.
+    """
+    stamp = '{} {}'.format(DataVersion.current(), datetime.datetime.utcnow().date()).encode('utf-8')
+    stamp_path = os.path.join(output_dir, STAMP_FILE)
+    if not force:
+        try:
+            with open(stamp_path, 'rb') as f:
+                if f.read() == stamp:
+                    return []
+        except IOError:
+            pass
+    client = app.test_client()
+    written = []
+    for path in page_paths():
+        resp = client.get(path)
+        if resp.status_code != 200:
+            continue
+        filename = os.path.join(output_dir, path.strip('/'), 'index.html')
+        if _write_if_changed(filename, resp.data):
+            written.append(filename)
+    _write_if_changed(stamp_path, stamp)
+    return written
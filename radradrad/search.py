@@ -0,0 +1,180 @@
+"""Full-text search over concert headliners and supports
+
+On SQLite builds with FTS5 the words are indexed in the concert_fts virtual
+table and ranked with bm25. Elsewhere, MySQL included, they are kept in the
+concert_token table and ranked by how many of the matched words are in the
+headliner. Either index is updated incrementally by update_index(), which
+indexes the concerts added since it last ran.
+"""
+
+import re
+
+from flask import render_template, request
+from sqlalchemy import case, desc, event, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+
+from radradrad import app, db, fold, venue_registry, Concert, ConcertArtist, ConcertToken, DailyAdded, DataVersion
+from radradrad.cache import cached_page, PageCache
+
+HEADLINER, SUPPORTS = 0, 1
+# How much more a word in the headliner counts than one in the supports
+HEADLINER_WEIGHT = 10
+
+SEARCH_PER_PAGE = 25
+# Words of a query beyond this are ignored
+MAX_QUERY_TOKENS = 8
+
+FTS_TABLE = 'concert_fts'
+
+# Whether each engine has the FTS5 table, by engine url
+_fts_tables = {}
+
+search_cache = PageCache(app.config['SEARCH_CACHE_MAX_BYTES'])
+
+
+def tokenize(text):
+    """
+    Returns the distinct words of text in order, folded to lower case without
+    accents so words the database collation considers equal are one token
+    """
+    tokens = []
+    for token in re.findall(r'\w+', fold(text)):
+        token = token[:64]
+        if token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def concert_tokens(concert_id, headliner, supports):
+    """
+    Returns the concert_token rows of a concert
+    """
+    rows = [{'token': token, 'concert_id': concert_id, 'field': HEADLINER} for token in tokenize(headliner)]
+    rows += [{'token': token, 'concert_id': concert_id, 'field': SUPPORTS} for token in tokenize(supports)]
+    return rows
+
+
+@event.listens_for(Concert.__table__, 'after_create')
+def _create_fts_table(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(headliner, supports)'.format(FTS_TABLE))
+    except OperationalError:
+        app.logger.warning('SQLite has no FTS5, searching with the concert_token table')
+    _fts_tables.pop(str(connection.engine.url), None)
+
+
+@event.listens_for(Concert.__table__, 'before_drop')
+def _drop_fts_table(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS {}'.format(FTS_TABLE))
+        _fts_tables.pop(str(connection.engine.url), None)
+
+
+def uses_fts():
+    """
+    Returns whether the database searches with the FTS5 table
+    """
+    engine = db.engine
+    key = str(engine.url)
+    if key not in _fts_tables:
+        _fts_tables[key] = engine.dialect.name == 'sqlite' and bool(db.session.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name",
+            {'name': FTS_TABLE}).scalar())
+    return _fts_tables[key]
+
+
+def update_index():
+    """
+    Index the concerts added since the last update, in the current transaction.
+    Returns the number of concerts indexed.
+    """
+    if uses_fts():
+        last_id = db.session.execute('SELECT COALESCE(MAX(rowid), 0) FROM {}'.format(FTS_TABLE)).scalar()
+    else:
+        last_id = db.session.query(func.coalesce(func.max(ConcertToken.concert_id), 0)).scalar()
+    concerts = db.session.query(Concert.id, Concert.headliner, Concert.supports) \
+        .filter(Concert.id > last_id).order_by(Concert.id).all()
+    if not concerts:
+        return 0
+    if uses_fts():
+        db.session.execute('INSERT INTO {} (rowid, headliner, supports) '
+                           'VALUES (:id, :headliner, :supports)'.format(FTS_TABLE),
+                           [{'id': concert_id, 'headliner': headliner or '', 'supports': supports or ''}
+                            for concert_id, headliner, supports in concerts])
+    else:
+        rows = [row for concert in concerts for row in concert_tokens(*concert)]
+        if rows:
+            # IGNORE skips any words MySQL's collation still finds equal
+            db.session.execute(ConcertToken.__table__.insert().prefix_with('IGNORE', dialect='mysql'), rows)
+    return len(concerts)
+
+
+def rebuild_index():
+    """
+    Reindex every concert and commit
+    """
+    if uses_fts():
+        db.session.execute('DELETE FROM {}'.format(FTS_TABLE))
+    else:
+        ConcertToken.query.delete()
+    count = update_index()
+    DataVersion.bump()
+    db.session.commit()
+    return count
+
+
+def _ranked_ids(tokens, limit, offset):
+    """
+    Returns the ids of concerts matching every token, best match first
+    """
+    if uses_fts():
+        match = ' '.join('"{}"'.format(token) for token in tokens)
+        rows = db.session.execute(
+            'SELECT {0}.rowid FROM {0} JOIN concert ON concert.id = {0}.rowid '
+            'WHERE {0} MATCH :match ORDER BY bm25({0}, {1}, 1.0), concert.date DESC, concert.id DESC '
+            'LIMIT :limit OFFSET :offset'.format(FTS_TABLE, float(HEADLINER_WEIGHT)),
+            {'match': match, 'limit': limit, 'offset': offset})
+        return [row[0] for row in rows]
+    score = func.sum(case([(ConcertToken.field == HEADLINER, HEADLINER_WEIGHT)], else_=1))
+    query = db.session.query(ConcertToken.concert_id) \
+        .join(Concert, Concert.id == ConcertToken.concert_id) \
+        .filter(ConcertToken.token.in_(tokens)) \
+        .group_by(ConcertToken.concert_id, Concert.date) \
+        .having(func.count(func.distinct(ConcertToken.token)) == len(tokens)) \
+        .order_by(desc(score), Concert.date.desc(), ConcertToken.concert_id.desc())
+    return [concert_id for concert_id, in query.limit(limit).offset(offset)]
+
+
+def search_concerts(query, page=1, per_page=SEARCH_PER_PAGE):
+    """
+    Returns a page of the concerts matching every word of query, best match
+    first, and whether there is a next page
+    """
+    tokens = tokenize(query)[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return [], False
+    ids = _ranked_ids(tokens, per_page + 1, (page - 1) * per_page)
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    if not ids:
+        return [], False
+    concerts = Concert.query.options(joinedload(Concert.venue)).filter(Concert.id.in_(ids)).all()
+    by_id = dict((concert.id, concert) for concert in concerts)
+    return [by_id[concert_id] for concert_id in ids if concert_id in by_id], has_next
+
+
+@app.route('/search')
+@cached_page(cache=search_cache)
+def search():
+    query = request.args.get('q', '')
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    concerts, has_next = search_concerts(query, page)
+    return render_template('search.html', venues=venue_registry.all(), added_today=DailyAdded.today(),
+                           query=query, concerts=concerts, page=page, has_next=has_next,
+                           lineups=ConcertArtist.lineups(concerts))
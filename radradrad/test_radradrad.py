@@ -1,12 +1,45 @@
 import datetime
+import json
+import pstats
+import shutil
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 import os
+from sqlalchemy import event
 
-from radradrad import app, db, Venue, Concert, timestamp
+from radradrad import app, db, venue_registry, Venue, Concert, DailyAdded, DataVersion, timestamp, start_timestamp, query_plan, uses_index
+from radradrad import Artist, ConcertArtist, ConcertsByDate
+from radradrad.cache import page_cache, PageCache
+from radradrad.publish import publish
+from radradrad import bench
+from radradrad import metrics
+from radradrad import search
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Creates the test database with the venues before each test and deletes it after
+    """
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+        self.app = app.test_client()
+        db.create_all()
+        Venue.create_all()
+        page_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        os.unlink(os.path.join(basedir, 'test.db'))
+
+
 class VenueTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -30,6 +63,14 @@ class VenueTestCase(unittest.TestCase):
         for name in expected_names:
             self.assertIn(name, rv)
 
+    def test_venue_registry_caches_until_invalidated(self):
+        self.assertEqual(len(venue_registry.all()), 4)
+        db.session.add(Venue(name='Brick and Mortar', location='sf'))
+        db.session.commit()
+        self.assertEqual(len(venue_registry.all()), 4)
+        venue_registry.invalidate()
+        self.assertIn('Brick and Mortar', venue_registry.ids_by_name())
+
 class ConcertTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -38,6 +79,7 @@ class ConcertTestCase(unittest.TestCase):
         self.app = app.test_client()
         db.create_all()
         Venue.create_all()
+        page_cache.clear()
 
         show_info = {"show_time": "9PM",
                      "show_url": "http://www.url.com",
@@ -49,7 +91,7 @@ class ConcertTestCase(unittest.TestCase):
         self.start_date = datetime.datetime.utcnow()
         for days in range(35):
             date = (self.start_date+datetime.timedelta(days))
-            concert = Concert(date=date.strftime('%Y-%m-%d'),
+            concert = Concert(date=date.date(),
                               created_at=timestamp(date.strftime('%Y-%m-%d')),
                               time=show_info['show_time'],
                               url=show_info['show_url'],
@@ -67,6 +109,22 @@ class ConcertTestCase(unittest.TestCase):
         db.drop_all()
         os.unlink(os.path.join(basedir, 'test.db'))
 
+    def count_queries(self, path):
+        """
+        Returns the number of SQL statements run to serve path
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.app.get(path)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements)
+
     def min_date(self, query):
         """
         Returns min/first/start date of Concert query
@@ -86,13 +144,13 @@ class ConcertTestCase(unittest.TestCase):
     def test_date_range_without_args_returns_correct_start_date(self):
         rv = Concert.date_range()
         start_date = self.min_date(rv).date
-        expected = datetime.datetime.now().strftime('%Y-%m-%d')
+        expected = datetime.datetime.now().date()
         self.assertEqual(start_date, expected)
 
     def test_date_range_without_args_returns_correct_end_date(self):
         rv = Concert.date_range()
         end_date = self.max_date(rv).date
-        expected = (datetime.datetime.now() + datetime.timedelta(28)).strftime('%Y-%m-%d')
+        expected = (datetime.datetime.now() + datetime.timedelta(28)).date()
         self.assertEqual(end_date, expected)
 
     def test_date_range_returns_count_with_args(self):
@@ -105,21 +163,481 @@ class ConcertTestCase(unittest.TestCase):
         start_date = self.start_date.strftime("%Y-%m-%d")
         end_date = (self.start_date+datetime.timedelta(10)).strftime("%Y-%m-%d")
         rv = Concert.date_range(start_date, end_date)
-        self.assertEqual(self.min_date(rv).date, start_date)
+        self.assertEqual(self.min_date(rv).date, self.start_date.date())
 
     def test_date_range_returns_end_date_with_args(self):
         start_date = self.start_date.strftime("%Y-%m-%d")
         end_date = (self.start_date+datetime.timedelta(10)).strftime("%Y-%m-%d")
         rv = Concert.date_range(start_date, end_date)
-        self.assertEqual(self.max_date(rv).date, end_date)
+        self.assertEqual(self.max_date(rv).date, (self.start_date+datetime.timedelta(10)).date())
 
     def test_added_today_returns_correct_count(self):
         rv = Concert.added_today()
         self.assertEqual(rv.count(), 1)
 
     def test_added_today_returns_correct_concert(self):
-        date_today = datetime.datetime.today().strftime('%Y-%m-%d')
+        date_today = datetime.datetime.today().date()
         rv = Concert.added_today()
         dates = set(concert.date for concert in rv)
         self.assertEqual(len(dates), 1)
         self.assertIn(date_today, list(dates))
+
+    def test_listing_queries_use_indexes(self):
+        for query in [Concert.date_range(), Concert.for_venue(1), Concert.for_artist(1), Concert.added_today()]:
+            self.assertTrue(uses_index(query_plan(query)))
+
+    def test_unindexed_query_is_full_scan(self):
+        self.assertFalse(uses_index(query_plan(Concert.query.filter(Concert.age == 'All Ages'))))
+
+    def test_concert_starts_at_defaults_from_date_and_time(self):
+        concert = Concert.query.first()
+        date = concert.date
+        expected = int(datetime.datetime(date.year, date.month, date.day, 21).timestamp())
+        self.assertEqual(concert.starts_at, expected)
+
+    def test_start_timestamp_uses_first_time(self):
+        date = datetime.date(2016, 8, 24)
+        expected = int(datetime.datetime(2016, 8, 24, 20, 30).timestamp())
+        self.assertEqual(start_timestamp(date, '8:30 pm'), expected)
+        self.assertEqual(start_timestamp(date, '8:30PM doors -- music at 9:00PM'), expected)
+        self.assertEqual(start_timestamp(date, 'TBA'), timestamp(date))
+
+    def test_index_renders_concerts(self):
+        rv = self.app.get('/')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'Headliner 0', rv.data)
+        self.assertIn(self.start_date.strftime('%A, %B %d, %Y').encode(), rv.data)
+
+    def test_listing_query_count_is_constant(self):
+        venue_registry.all()
+        for path in ['/', '/venue/1', '/new']:
+            self.assertEqual(self.count_queries(path), 4)
+            self.assertEqual(self.count_queries(path), 1)
+
+    def test_daily_added_rebuild_counts_todays_concert(self):
+        self.assertEqual(DailyAdded.today(), 0)
+        version = DataVersion.current()
+        DailyAdded.rebuild()
+        self.assertEqual(DataVersion.current(), version + 1)
+        self.assertEqual(DailyAdded.today(), Concert.added_today().count())
+        self.assertEqual(DailyAdded.query.count(), 35)
+
+    def test_daily_added_record_increments_day(self):
+        DailyAdded.record(2)
+        DailyAdded.record(3)
+        db.session.commit()
+        self.assertEqual(DailyAdded.today(), 5)
+        self.assertIn(b'Concerts added today: 5', self.app.get('/').data)
+
+    def test_cached_page_answers_if_none_match(self):
+        rv = self.app.get('/')
+        etag = rv.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        rv = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_data_version_bump_rerenders_page(self):
+        etag = self.app.get('/').headers['ETag']
+        db.session.add(Concert(date=self.start_date.date(), time='10PM', url='http://www.url.com',
+                               headliner='Late Show', venue_id=1))
+        db.session.commit()
+        self.assertNotIn(b'Late Show', self.app.get('/').data)
+        DataVersion.bump()
+        db.session.commit()
+        rv = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'Late Show', rv.data)
+
+    def test_streamed_listings_match_rendered_listings(self):
+        rendered = [self.app.get(path).data for path in ['/', '/venue/1']]
+        page_cache.clear()
+        app.config['STREAM_LISTINGS'] = True
+        try:
+            streamed = [self.app.get(path).data for path in ['/', '/venue/1']]
+        finally:
+            app.config['STREAM_LISTINGS'] = False
+        self.assertEqual(streamed, rendered)
+        self.assertEqual(page_cache.size, 0)
+
+
+class PageCacheTestCase(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = PageCache(max_bytes=10)
+        cache.set('a', b'12345', 'a')
+        cache.set('b', b'12345', 'b')
+        cache.get('a')
+        cache.set('c', b'12345', 'c')
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 10)
+
+    def test_skips_pages_over_max_bytes(self):
+        cache = PageCache(max_bytes=4)
+        cache.set('a', b'12345', 'a')
+        self.assertIsNone(cache.get('a'))
+
+
+class PublishTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(PublishTestCase, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        super(PublishTestCase, self).tearDown()
+
+    def test_publish_writes_listing_pages(self):
+        written = publish(self.output_dir)
+        self.assertEqual(len(written), 2 + len(venue_registry.all()))
+        for path in ['index.html', 'new/index.html', 'venue/1/index.html']:
+            self.assertTrue(os.path.isfile(os.path.join(self.output_dir, path)))
+
+    def test_publish_skips_unchanged_pages(self):
+        publish(self.output_dir)
+        self.assertEqual(publish(self.output_dir), [])
+        DailyAdded.record(1)
+        DataVersion.bump()
+        db.session.commit()
+        self.assertEqual(len(publish(self.output_dir)), 2 + len(venue_registry.all()))
+
+    def test_publish_rerenders_on_a_new_day(self):
+        publish(self.output_dir)
+        os.unlink(os.path.join(self.output_dir, 'index.html'))
+        self.assertEqual(publish(self.output_dir), [])
+        with open(os.path.join(self.output_dir, '.published'), 'w') as f:
+            f.write('0 2016-08-01')
+        self.assertEqual(publish(self.output_dir), [os.path.join(self.output_dir, 'index.html')])
+        self.assertEqual(publish(self.output_dir, force=True), [])
+
+
+class ApiTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(ApiTestCase, self).setUp()
+        self.start_date = datetime.date(2016, 8, 1)
+        for days in range(10):
+            for venue_id in (1, 2):
+                db.session.add(Concert(date=self.start_date + datetime.timedelta(days),
+                                       created_at=days,
+                                       time='9PM',
+                                       url='http://www.url.com',
+                                       headliner='Headliner {} {}'.format(days, venue_id),
+                                       supports='Support A,Support B',
+                                       venue_id=venue_id))
+        db.session.commit()
+
+    def get_json(self, **params):
+        params.setdefault('start', '2016-08-01')
+        params.setdefault('end', '2016-08-31')
+        rv = self.app.get('/api/concerts', query_string=params)
+        return rv.status_code, json.loads(rv.data.decode('utf-8'))
+
+    def test_api_pages_through_all_concerts(self):
+        seen = []
+        status, page = self.get_json(limit=3)
+        while True:
+            self.assertEqual(status, 200)
+            seen.extend(concert['id'] for concert in page['concerts'])
+            if page['next'] is None:
+                break
+            status, page = self.get_json(limit=3, cursor=page['next'])
+        self.assertEqual(len(seen), 20)
+        self.assertEqual(len(set(seen)), 20)
+
+    def test_api_filters_by_venue_and_since(self):
+        status, page = self.get_json(venue=2, since=8)
+        self.assertEqual([concert['headliner'] for concert in page['concerts']],
+                         ['Headliner 8 2', 'Headliner 9 2'])
+        self.assertEqual(page['concerts'][0]['supports'], ['Support A', 'Support B'])
+        self.assertEqual(page['concerts'][0]['venue']['name'], 'The Vestry')
+
+    def test_api_rejects_bad_arguments(self):
+        for params in [{'limit': 'x'}, {'venue': 99}, {'cursor': 'nope'}, {'start': '08/01/2016'}]:
+            status, body = self.get_json(**params)
+            self.assertEqual(status, 400)
+            self.assertIn('error', body)
+
+
+class SearchTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(SearchTestCase, self).setUp()
+        search.search_cache.clear()
+        concerts = [('Sleater-Kinney', 'Big Joanie'),
+                    ('Big Thief', 'Sleater-Kinney Tribute'),
+                    ('Big Joanie', None),
+                    ('Thee Oh Sees', 'Big Business')]
+        for days, (headliner, supports) in enumerate(concerts):
+            db.session.add(Concert(date=datetime.date(2016, 8, 1) + datetime.timedelta(days),
+                                   time='9PM',
+                                   url='http://www.url.com',
+                                   headliner=headliner,
+                                   supports=supports,
+                                   venue_id=1))
+        db.session.commit()
+
+    def tearDown(self):
+        search._fts_tables.clear()
+        super(SearchTestCase, self).tearDown()
+
+    def headliners(self, query, **kwargs):
+        concerts, has_next = search.search_concerts(query, **kwargs)
+        return [concert.headliner for concert in concerts], has_next
+
+    def check_search(self):
+        self.assertEqual(search.update_index(), 4)
+        self.assertEqual(search.update_index(), 0)
+        self.assertEqual(self.headliners('sleater kinney'), (['Sleater-Kinney', 'Big Thief'], False))
+        self.assertEqual(self.headliners('BIG joanie'), (['Big Joanie', 'Sleater-Kinney'], False))
+        self.assertEqual(self.headliners('big', per_page=2), (['Big Joanie', 'Big Thief'], True))
+        headliners, has_next = self.headliners('big', page=2, per_page=2)
+        self.assertEqual((sorted(headliners), has_next), (['Sleater-Kinney', 'Thee Oh Sees'], False))
+        self.assertEqual(self.headliners('nobody'), ([], False))
+        self.assertEqual(self.headliners('" OR *'), ([], False))
+
+    def test_search_with_fts(self):
+        self.assertTrue(search.uses_fts())
+        self.check_search()
+
+    def test_search_with_token_table(self):
+        search._fts_tables[str(db.engine.url)] = False
+        self.check_search()
+        self.assertGreater(search.ConcertToken.query.count(), 0)
+
+    def test_index_picks_up_new_concerts(self):
+        search.update_index()
+        db.session.add(Concert(date=datetime.date(2016, 9, 1), time='9PM', url='http://www.url.com',
+                               headliner='Joanna Newsom', venue_id=2))
+        self.assertEqual(search.update_index(), 1)
+        self.assertEqual(self.headliners('newsom'), (['Joanna Newsom'], False))
+        version = DataVersion.current()
+        self.assertEqual(search.rebuild_index(), 5)
+        self.assertEqual(DataVersion.current(), version + 1)
+
+    def test_accented_words_are_folded(self):
+        self.assertEqual(search.tokenize('Björk BJORK bjork '), ['bjork'])
+        search._fts_tables[str(db.engine.url)] = False
+        db.session.add(Concert(date=datetime.date(2016, 9, 1), time='9PM', url='http://www.url.com',
+                               headliner='Björk Bjork', venue_id=2))
+        search.update_index()
+        self.assertEqual(self.headliners('bjork'), (['Björk Bjork'], False))
+        self.assertEqual(self.headliners('BJÖRK'), (['Björk Bjork'], False))
+
+    def test_search_page(self):
+        search.update_index()
+        rv = self.app.get('/search?q=thief')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'Big Thief', rv.data)
+        self.assertNotIn(b'Thee Oh Sees', rv.data)
+        self.assertEqual(self.app.get('/search?q=big&page=x').status_code, 200)
+
+    def test_search_pages_are_cached_apart_from_listings(self):
+        search.update_index()
+        self.app.get('/search?q=thief')
+        self.assertEqual(page_cache.size, 0)
+        self.assertGreater(search.search_cache.size, 0)
+
+
+class ArtistTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(ArtistTestCase, self).setUp()
+        today = datetime.datetime.utcnow().date()
+        self.lineups = {}
+        for days, lineup in [(-1, ['Big Thief', 'Lomelda']),
+                             (1, ['Lomelda', None]),
+                             (2, ['Sleater-Kinney', 'big  thief', 'Big Thief'])]:
+            concert = Concert(date=today + datetime.timedelta(days), time='9PM', url='http://www.url.com',
+                              headliner=lineup[0], venue_id=1)
+            db.session.add(concert)
+            db.session.flush()
+            self.lineups[concert.id] = lineup
+        ConcertArtist.link(self.lineups)
+        db.session.commit()
+
+    def test_artists_are_matched_case_insensitively(self):
+        self.assertEqual(sorted(artist.name for artist in Artist.query), ['Big Thief', 'Lomelda', 'Sleater-Kinney'])
+        self.assertEqual(ConcertArtist.query.count(), 5)
+        ids = Artist.ids_by_key(['LOMELDA', 'Waxahatchee'])
+        self.assertEqual(Artist.query.get(ids['lomelda']).name, 'Lomelda')
+        self.assertEqual(Artist.query.get(ids['waxahatchee']).name, 'Waxahatchee')
+
+    def test_lineup_positions(self):
+        concert_id = max(self.lineups)
+        positions = db.session.query(ConcertArtist.position, Artist.name) \
+            .join(Artist, Artist.id == ConcertArtist.artist_id) \
+            .filter(ConcertArtist.concert_id == concert_id).order_by(ConcertArtist.position).all()
+        self.assertEqual(positions, [(0, 'Sleater-Kinney'), (1, 'Big Thief')])
+
+    def test_variant_spellings_share_an_artist(self):
+        ids = Artist.ids_by_key(['Björk', 'BJORK '])
+        self.assertEqual(list(ids), ['bjork'])
+        self.assertEqual(Artist.ids_by_key(['Bjork']), ids)
+        self.assertEqual(Artist.query.get(ids['bjork']).name, 'Björk')
+
+    def test_listings_link_to_artist_pages(self):
+        lomelda = Artist.query.filter(Artist.key == 'lomelda').one()
+        rv = self.app.get('/')
+        self.assertIn('href="/artist/{}">Lomelda</a>'.format(lomelda.id).encode(), rv.data)
+
+    def test_streamed_lineups_load_per_batch(self):
+        concerts = ConcertsByDate(Concert.date_range(), batch_size=1)
+        seen = []
+        for date, day_concerts in concerts.items():
+            for concert in day_concerts:
+                seen.append(concert.id in concerts.lineups)
+            self.assertLessEqual(len(concerts.lineups), len(day_concerts) + concerts.batch_size)
+        self.assertEqual(seen, [True, True])
+
+    def test_artist_page_lists_upcoming_concerts(self):
+        big_thief = Artist.query.filter(Artist.key == 'big thief').one()
+        self.assertEqual([concert.headliner for concert in Concert.for_artist(big_thief.id)], ['Sleater-Kinney'])
+        rv = self.app.get('/artist/{}'.format(big_thief.id))
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'Big Thief', rv.data)
+        self.assertIn(b'Sleater-Kinney', rv.data)
+        self.assertEqual(self.app.get('/artist/999').status_code, 404)
+
+
+class MetricsTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        metrics.route_metrics.routes.clear()
+        app.config['METRICS_TOKEN'] = 'secret'
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        app.config['METRICS_DIR'] = None
+        app.config['METRICS_TOKEN'] = None
+        shutil.rmtree(self.dir)
+        super(MetricsTestCase, self).tearDown()
+
+    def get(self, path, token='secret'):
+        rv = self.app.get(path, headers={'Authorization': 'Bearer ' + token})
+        rv.get_data()
+        rv.close()
+        return rv
+
+    def metric(self, body, name):
+        for line in body.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split(' ')[1])
+
+    def test_metrics_record_latency_and_queries_by_route(self):
+        self.get('/')
+        self.get('/')
+        self.get('/new')
+        body = self.get('/metrics').data.decode('utf-8')
+        self.assertEqual(self.metric(body, 'radradrad_request_duration_seconds_count{route="index"}'), 2)
+        self.assertEqual(self.metric(body, 'radradrad_request_duration_seconds_bucket{route="index",le="+Inf"}'), 2)
+        self.assertEqual(self.metric(body, 'radradrad_requests_total{route="new",status="200"}'), 1)
+        self.assertGreater(self.metric(body, 'radradrad_sql_queries_total{route="index"}'), 0)
+        self.assertGreater(self.metric(body, 'radradrad_sql_query_seconds_total{route="index"}'), 0)
+        self.assertNotIn('route="metrics"', body)
+
+    def test_metrics_add_up_workers(self):
+        app.config['METRICS_DIR'] = self.dir
+        self.get('/new')
+        other_worker = {'new': {'buckets': [1] * len(metrics.BUCKETS), 'count': 1, 'sum': 0.001,
+                                'queries': 2, 'query_seconds': 0.0005, 'statuses': {'200': 1}}}
+        with open(os.path.join(self.dir, '1.json'), 'w') as f:
+            json.dump(other_worker, f)
+        body = self.get('/metrics').data.decode('utf-8')
+        self.assertEqual(self.metric(body, 'radradrad_request_duration_seconds_count{route="new"}'), 2)
+        self.assertEqual(self.metric(body, 'radradrad_requests_total{route="new",status="200"}'), 2)
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, '{}.json'.format(os.getpid()))))
+
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.get('/metrics', token='wrong').status_code, 404)
+        app.config['METRICS_TOKEN'] = None
+        self.assertEqual(self.get('/metrics', token='').status_code, 404)
+
+    def test_held_back_flush_is_written_later(self):
+        app.config['METRICS_DIR'] = self.dir
+        path = os.path.join(self.dir, '{}.json'.format(os.getpid()))
+        with mock.patch.object(metrics, 'FLUSH_INTERVAL', 0.05):
+            self.get('/new')
+            self.get('/')
+            time.sleep(0.2)
+        with open(path) as f:
+            self.assertEqual(sorted(json.load(f)), ['index', 'new'])
+
+    def test_debug_toolbar_is_off_in_production(self):
+        import radradrad
+        self.assertIsNone(radradrad.toolbar)
+
+
+class ProfilerTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        app.config['PROFILE_DIR'] = self.dir
+        app.config['PROFILE_TOKEN'] = 'secret'
+
+    def tearDown(self):
+        app.config['PROFILE_DIR'] = None
+        app.config['PROFILE_TOKEN'] = None
+        app.config['PROFILE_ONE_IN'] = 0
+        app.config['PROFILE_MAX_BYTES'] = 50 * 1024 * 1024
+        shutil.rmtree(self.dir)
+        super(ProfilerTestCase, self).tearDown()
+
+    def get(self, path, **kwargs):
+        rv = self.app.get(path, **kwargs)
+        rv.get_data()
+        rv.close()
+        page_cache.clear()
+        return rv
+
+    def dumps(self, suffix):
+        return sorted(name for name in os.listdir(self.dir) if name.endswith(suffix))
+
+    def test_profile_requested_by_header(self):
+        self.get('/venue/1')
+        self.get('/venue/1', headers={'X-Profile': 'wrong'})
+        self.assertEqual(os.listdir(self.dir), [])
+        self.get('/venue/1', headers={'X-Profile': 'secret'})
+        profile, = self.dumps('.prof')
+        self.assertIn('-venue-', profile)
+        stats = pstats.Stats(os.path.join(self.dir, profile))
+        self.assertGreater(stats.total_calls, 0)
+        with open(os.path.join(self.dir, self.dumps('.json')[0])) as f:
+            info = json.load(f)
+        self.assertEqual(info['endpoint'], 'venue')
+        self.assertEqual(info['view_args'], {'venue_id': 1})
+        self.assertTrue(any('FROM concert' in query['statement'] for query in info['statements']))
+
+    def test_one_in_n_requests_are_profiled(self):
+        app.config['PROFILE_ONE_IN'] = 2
+        for _ in range(4):
+            self.get('/new')
+        self.assertEqual(len(self.dumps('.prof')), 2)
+
+    def test_old_profiles_are_rotated_out(self):
+        app.config['PROFILE_MAX_BYTES'] = 1
+        self.get('/new', headers={'X-Profile': 'secret'})
+        self.assertEqual(os.listdir(self.dir), [])
+        app.config['PROFILE_MAX_BYTES'] = 50 * 1024 * 1024
+        for _ in range(3):
+            self.get('/new', headers={'X-Profile': 'secret'})
+        app.config['PROFILE_MAX_BYTES'] = sum(os.path.getsize(os.path.join(self.dir, name))
+                                              for name in os.listdir(self.dir)) - 1
+        self.get('/new', headers={'X-Profile': 'secret'})
+        self.assertLess(len(self.dumps('.prof')), 4)
+
+
+class BenchmarkTestCase(DatabaseTestCase):
+
+    def test_seed_and_run_report_each_route(self):
+        bench.seed(concerts=500, venues=5)
+        self.assertEqual(Concert.query.count(), 500)
+        self.assertEqual(DailyAdded.today(), 5)
+        results = bench.run(['/', '/venue/1'], requests=2)
+        for path in ['/', '/venue/1']:
+            self.assertEqual(results[path]['queries_per_request'], 4)
+            self.assertGreater(results[path]['rows_per_request'], 0)
+            self.assertLessEqual(results[path]['p50_ms'], results[path]['p99_ms'])
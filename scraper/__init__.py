@@ -1,53 +1,226 @@
 """Collection of functions to scrape various concert calendars"""
 
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlparse
 
+import os
 import re
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+from sqlalchemy import and_, event, or_
 
-from radradrad import db, Venue, Concert
+from radradrad import app, db, fold, venue_registry, Venue, Concert, ConcertArtist, DailyAdded, DataVersion
+from radradrad.publish import publish
+from radradrad.search import update_index
+from scraper.cache import ResponseCache, RowFingerprints
+from scraper.metrics import RunMetrics
+from scraper.schedule import ScrapeScheduler
 
+basedir = os.path.abspath(os.path.dirname(__file__))
 
-def _get_soup(url):
+# Number of venues fetched at once, and how many of those may hit the same host
+SCRAPER_WORKERS = int(os.environ.get('SCRAPER_WORKERS', 4))
+SCRAPER_MAX_PER_HOST = int(os.environ.get('SCRAPER_MAX_PER_HOST', 2))
+# Seconds to wait for a calendar's server to connect or send data
+SCRAPER_HTTP_TIMEOUT = float(os.environ.get('SCRAPER_HTTP_TIMEOUT', 30))
+# BeautifulSoup tree builder: html.parser, lxml or html5lib
+SCRAPER_PARSER = os.environ.get('SCRAPER_PARSER', 'html.parser')
+# Scrape and parse every calendar and row even when unchanged or not yet due
+SCRAPER_FORCE_PARSE = bool(os.environ.get('SCRAPER_FORCE_PARSE'))
+# Processes parsing the rows of large calendars, 0 to parse in the scraping thread
+SCRAPER_PARSE_PROCESSES = int(os.environ.get('SCRAPER_PARSE_PROCESSES', 0))
+# Calendars with fewer new rows than this are parsed serially
+SCRAPER_PARSE_POOL_MIN_ROWS = int(os.environ.get('SCRAPER_PARSE_POOL_MIN_ROWS', 200))
+# Seconds after which a run stops starting venue scrapers, 0 for no limit
+SCRAPER_TIME_BUDGET = float(os.environ.get('SCRAPER_TIME_BUDGET', 0)) or None
+# File each run's metrics are appended to as a line of JSON
+SCRAPER_METRICS_FILE = os.environ.get('SCRAPER_METRICS_FILE')
+
+metrics = RunMetrics()
+
+
+def _count_round_trip(*args):
+    metrics.add('db_round_trips')
+
+
+response_cache = ResponseCache(os.environ.get('SCRAPER_CACHE_DIR', os.path.join(basedir, '.cache')))
+scheduler = ScrapeScheduler(os.path.join(response_cache.path, 'schedule.json'))
+row_fingerprints = RowFingerprints(os.path.join(response_cache.path, 'fingerprints.json'))
+
+VenueScraper = namedtuple('VenueScraper', 'name url scrape min_interval max_interval')
+
+# Registered venue scrapers by venue name, in registration order
+venue_scrapers = OrderedDict()
+
+
+def venue_scraper(name, url, min_interval=30 * 60, max_interval=24 * 60 * 60):
+    """
+    Register a function as the scraper for a venue's calendar at url.
+    The scheduler scrapes the venue between every min_interval and
+    max_interval seconds depending on how often its calendar changes.
+    """
+    def register(scrape):
+        venue_scrapers[name] = VenueScraper(name, url, scrape, min_interval, max_interval)
+        return scrape
+    return register
+
+session = requests.Session()
+session.headers['User-Agent'] = 'radradrad Concert Calendar v0.1 (radradrad.com)'
+session.mount('http://', HTTPAdapter(pool_maxsize=SCRAPER_WORKERS))
+session.mount('https://', HTTPAdapter(pool_maxsize=SCRAPER_WORKERS))
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def _host_limit(url):
     """
-    Return soup of calendar
+    Return the semaphore capping concurrent requests to the host of url
     """
-    headers = {'User-Agent': 'radradrad Concert Calendar v0.1 (radradrad.com)'}
-    resp = requests.get(url, headers=headers)
-    soup = BeautifulSoup(resp.content, 'html.parser')
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(SCRAPER_MAX_PER_HOST)
+        return _host_limits[host]
+
+
+def _make_soup(markup, parse_only=None):
+    """
+    Return soup of markup built with SCRAPER_PARSER.
+    html5lib always builds the whole tree, so parse_only is dropped for it.
+    """
+    if SCRAPER_PARSER == 'html5lib':
+        parse_only = None
+    return BeautifulSoup(markup, SCRAPER_PARSER, parse_only=parse_only)
+
+
+def _get_soup(url, parse_only=None):
+    """
+    Return soup of calendar, or None if it is unchanged since the last run.
+    parse_only is a SoupStrainer limiting the tree to what the scraper reads.
+    """
+    with _host_limit(url), metrics.stage('fetch'):
+        resp = session.get(url, headers=response_cache.validators(url), timeout=SCRAPER_HTTP_TIMEOUT)
+        if resp.status_code == 304 and response_cache.body(url) is None:
+            # Nothing saved to fall back on, so fetch the whole page
+            resp = session.get(url, timeout=SCRAPER_HTTP_TIMEOUT)
+    content = resp.content
+    metrics.add('bytes_fetched', len(content))
+    if resp.status_code in (200, 304) and not response_cache.store(url, resp):
+        metrics.add('calendars_unchanged')
+        if not SCRAPER_FORCE_PARSE:
+            return None
+        content = response_cache.body(url)
+    with metrics.stage('build_tree'):
+        soup = _make_soup(content, parse_only)
     return soup
 
 
+def insert_shows(shows):
+    """
+    Insert concerts not already in the database.
+    Existing concerts in the scraped date window are loaded with one query
+    and the new ones are written with a single bulk insert. The daily added
+    count, the data version, the artist lineups and the search index are
+    updated in the same transaction.
+    Returns the list of new shows.
+    """
+    # Only the statements run here count as the scrape's round trips,
+    # not the publish renders or anything else sharing the engine
+    event.listen(db.engine, 'before_cursor_execute', _count_round_trip)
+    try:
+        with metrics.stage('dedupe'):
+            new_shows, rows = _new_rows(shows)
+        metrics.add('shows_new', len(rows))
+        metrics.add('shows_duplicate', len(shows) - len(rows))
+        if rows:
+            with metrics.stage('insert'):
+                # IGNORE skips a show the unique index still considers a duplicate
+                # rather than rolling back every other new show
+                db.session.execute(Concert.__table__.insert().prefix_with('IGNORE', dialect='mysql'), rows)
+                DailyAdded.record(len(rows))
+                DataVersion.bump()
+            with metrics.stage('link_artists'):
+                _link_artists(new_shows, rows)
+            with metrics.stage('search_index'):
+                update_index()
+        return new_shows
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _count_round_trip)
+
+
+def _link_artists(new_shows, rows):
+    """
+    Add the headliner and supports of just inserted concerts to their lineups
+    """
+    dates = [row['date'] for row in rows if row['date']]
+    windows = []
+    if dates:
+        windows.append(and_(Concert.date >= min(dates), Concert.date <= max(dates)))
+    if len(dates) < len(rows):
+        windows.append(Concert.date == None)
+    ids = dict((_show_key(headliner, date, time_), concert_id) for concert_id, headliner, date, time_ in
+               db.session.query(Concert.id, Concert.headliner, Concert.date, Concert.time).filter(or_(*windows)))
+    lineups = {}
+    for show_info, row in zip(new_shows, rows):
+        concert_id = ids.get(_show_key(row['headliner'], row['date'], row['time']))
+        if concert_id is not None:
+            lineups[concert_id] = [show_info['show_headliner']] + list(show_info['show_supports'] or [])
+    ConcertArtist.link(lineups)
+
+
+def _show_key(headliner, date, time_):
+    """
+    Return the key of a concert's unique (date, time, headliner) index, which
+    MySQL compares ignoring case, accents and trailing spaces
+    """
+    return fold(headliner), date, fold(time_)
+
+
+def _new_rows(shows):
+    """
+    Returns the shows not in the database, or earlier in shows, and their
+    concert rows
+    """
+    dates = [show_info['show_date'].date() for show_info in shows if show_info['show_date']]
+    existing = set()
+    if dates:
+        existing = set(_show_key(headliner, date, time_) for headliner, date, time_ in
+                       db.session.query(Concert.headliner, Concert.date, Concert.time)
+                       .filter(Concert.date >= min(dates), Concert.date <= max(dates)))
+    venue_ids = venue_registry.ids_by_name()
+
+    new_shows = []
+    rows = []
+    for show_info in shows:
+        show_date = show_info['show_date'].date() if show_info['show_date'] else None
+        key = _show_key(show_info['show_headliner'], show_date, show_info['show_time'])
+        if key in existing:
+            continue
+        existing.add(key)
+        new_shows.append(show_info)
+        rows.append({'date': show_date,
+                     'time': show_info['show_time'],
+                     'url': show_info['show_url'],
+                     'headliner': show_info['show_headliner'],
+                     'supports': ','.join(show_info['show_supports']) if show_info['show_supports'] else None,
+                     'age': show_info['show_age'],
+                     'cost': show_info['show_cost'],
+                     'venue_id': venue_ids.get(show_info['show_location'])})
+    return new_shows, rows
+
+
 def insert_show(show_info):
     """
     Insert concert if not in database, else skip it
     """
-    show_location = show_info['show_location']
-    concert = Concert.query.filter_by(headliner=show_info['show_headliner'],
-                                      date=show_info['show_date'],
-                                      time=show_info['show_time']).first()
-#    if concert:
-#        print('concert exists {}'.format(concert.headliner))
-#        concert.date = show_date
-#        concert.time = show_time
-#        concert.url = show_url
-#        concert.headliner = show_headliner
-#        concert.supports = show_supports
-#        concert.age = show_age
-#        concert.cost = show_cost
-#
-    if concert is None:
-        venue = Venue.query.filter_by(name=show_location).first()
-        concert = Concert(date=show_info['show_date'],
-                          time=show_info['show_time'],
-                          url=show_info['show_url'],
-                          headliner=show_info['show_headliner'],
-                          supports=','.join(show_info['show_supports']) if show_info['show_supports'] else None,
-                          age=show_info['show_age'],
-                          cost=show_info['show_cost'],
-                          venue=venue)
-        db.session.add(concert)
+    return insert_shows([show_info])
 
 
 def parse_chapel(show_date, raw_show):
@@ -55,7 +228,6 @@ def parse_chapel(show_date, raw_show):
     Parses shows for The Chapel SF
     """
     show = raw_show
-    show_date = show_date.strftime('%Y-%m-%d')
     base_url = 'http://www.thechapelsf.com'
     show_url = show.find(class_='url')
     if show_url:
@@ -120,7 +292,7 @@ def parse_both(raw_show):
     show_date = [date.text for date in show.findAll(class_='date')]
     if show_date:
         show_date = ''.join(show_date).strip('\n')
-        show_date = datetime.strptime(show_date, '%A %B %d %Y').strftime('%Y-%m-%d')
+        show_date = datetime.strptime(show_date, '%A %B %d %Y')
 
     show_time = ''.join([x.text for x in show.findAll(class_='time')])
     if show_time:
@@ -152,16 +324,90 @@ def parse_both(raw_show):
     return show_info
 
 
+def _parse_chapel_html(show_date, html):
+    return parse_chapel(show_date, _make_soup(html).find('div', class_='one-event'))
+
+
+def _parse_both_html(html):
+    return parse_both(_make_soup('<table>{}</table>'.format(html)).find('tr'))
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def _get_parse_pool(processes):
+    """
+    Return the parse pool, starting it on first use. Its workers are started
+    by a fork server, or spawned, rather than forked from whichever scraper
+    thread first needs them, since forking a threaded process can copy a
+    lock another thread holds and deadlock the worker.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _parse_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(method))
+        return _parse_pool
+
+
+def parse_rows(rows, parse, parse_html, processes=None):
+    """
+    Parse rows, each a tuple of arguments to parse ending with the show's tag.
+    Once there are at least SCRAPER_PARSE_POOL_MIN_ROWS rows they are sent to
+    a process pool as HTML strings and parsed by parse_html instead.
+    Returns the parsed shows in the order of rows.
+    """
+    processes = SCRAPER_PARSE_PROCESSES if processes is None else processes
+    metrics.add('shows_parsed', len(rows))
+    with metrics.stage('parse'):
+        if not processes or len(rows) < SCRAPER_PARSE_POOL_MIN_ROWS:
+            return [parse(*row) for row in rows]
+        columns = list(zip(*rows))
+        columns[-1] = [str(show) for show in columns[-1]]
+        chunksize = max(1, len(rows) // (processes * 4))
+        return list(_get_parse_pool(processes).map(parse_html, *columns, chunksize=chunksize))
+
+
+def shutdown_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown()
+            _parse_pool = None
+
+
+def _seen_rows(venue):
+    """
+    Return the fingerprints of venue's rows to skip, none when forced
+    """
+    if SCRAPER_FORCE_PARSE:
+        return set()
+    return row_fingerprints.seen(venue)
+
+
+# Parts of each calendar page the venue scrapers read
+CHAPEL_STRAINER = SoupStrainer(class_='vevent')
+BOTH_STRAINER = SoupStrainer('table', id='listings')
+
+
+@venue_scraper('The Chapel', 'http://www.thechapelsf.com/calendar/')
 def chapel():
     """
     Scrapes calendar information from The Chapel SF website.
+    Returns None if the calendar is unchanged since the last run, and
+    leaves out shows whose markup is unchanged.
     """
-    chapel_shows = []
+    rows = []
     base_url = 'http://www.thechapelsf.com'
     calendar_url = ''.join([base_url, '/calendar/'])
 
-    soup = _get_soup(calendar_url)
+    soup = _get_soup(calendar_url, parse_only=CHAPEL_STRAINER)
+    if soup is None:
+        return None
 
+    seen = _seen_rows('The Chapel')
+    fingerprints = set()
     show_calendar = soup.findAll(class_='vevent')
     for day in show_calendar:
         show_date = day.find('span', class_='value-title').get('title')
@@ -170,29 +416,48 @@ def chapel():
 
         shows = day.findAll('div', class_='one-event')
         for show in shows:
-            show_info = parse_chapel(show_date, show)
-            chapel_shows.append(show_info)
-
+            fingerprint = row_fingerprints.fingerprint(show_date, show)
+            fingerprints.add(fingerprint)
+            if fingerprint in seen:
+                metrics.add('shows_unchanged')
+                continue
+            rows.append((show_date, show))
+
+    chapel_shows = parse_rows(rows, parse_chapel, _parse_chapel_html)
+    row_fingerprints.update('The Chapel', fingerprints)
     return chapel_shows
 
 
+@venue_scraper('Bottom of the Hill', 'http://www.bottomofthehill.com/calendar.html')
 def both():
     """
     Scrapes calendar information from Bottom of the Hill website.
+    Returns None if the calendar is unchanged since the last run, and
+    leaves out shows whose markup is unchanged.
     """
 
-    both_shows = []
+    rows = []
     base_url = 'http://www.bottomofthehill.com'
     calendar_url = ''.join([base_url, '/calendar.html'])
 
-    soup = _get_soup(calendar_url)
+    soup = _get_soup(calendar_url, parse_only=BOTH_STRAINER)
+    if soup is None:
+        return None
 
+    seen = _seen_rows('Bottom of the Hill')
+    fingerprints = set()
     show_calendar = soup.find('table', id='listings').findAll('tr')
     for show in show_calendar:
         if show.find(class_='date'):
-            show_info = parse_both(show)
-            both_shows.append(show_info)
-
+            fingerprint = row_fingerprints.fingerprint(show)
+            fingerprints.add(fingerprint)
+            if fingerprint in seen:
+                metrics.add('shows_unchanged')
+                continue
+            rows.append((show,))
+
+    both_shows = parse_rows(rows, parse_both, _parse_both_html)
+    row_fingerprints.update('Bottom of the Hill', fingerprints)
     return both_shows
 
 
@@ -201,18 +466,71 @@ def init_db():
     Venue.create_all()
 
 
+# Stands in for the shows of venues skipped for lack of time
+_SKIPPED = object()
+
+
+def scrape_venues(venues, workers=None, budget=None):
+    """
+    Run venue scrapers in a bounded thread pool.
+    Returns an OrderedDict of each venue's shows, in the same order as venues,
+    with None for venues whose calendar is unchanged. Venues not started
+    within budget seconds, and venues whose calendar could not be fetched,
+    are left out so they stay due.
+    """
+    venues = list(venues)
+    workers = workers or SCRAPER_WORKERS
+    started = time.time()
+
+    def scrape(venue):
+        if budget is not None and time.time() - started > budget:
+            metrics.add('venues_skipped')
+            return _SKIPPED
+        with metrics.venue(venue.name):
+            try:
+                return venue.scrape()
+            except requests.RequestException as e:
+                metrics.add('venues_failed')
+                print('Fetching {} failed: {}'.format(venue.name, e))
+                return _SKIPPED
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(scrape, venues))
+    return OrderedDict((venue.name, venue_shows) for venue, venue_shows in zip(venues, results)
+                       if venue_shows is not _SKIPPED)
+
+
 def main():
+    metrics.start()
     init_db()
     concerts = []
-    venues = {'The Chapel': chapel,
-              'Bottom of the Hill': both}
-    for venue in venues.values():
-        concerts.extend(venue())
-    for concert in concerts:
-        print('Concert: {}'.format(concert))
-        insert_show(concert)
-    db.session.commit()
-
+    due = scheduler.due(venue_scrapers.values(), force=SCRAPER_FORCE_PARSE)
+    try:
+        scraped = scrape_venues(due, budget=SCRAPER_TIME_BUDGET)
+    finally:
+        shutdown_parse_pool()
+    for name, venue_shows in scraped.items():
+        scheduler.record(venue_scrapers[name], changed=venue_shows is not None)
+        if venue_shows is not None:
+            concerts.extend(venue_shows)
+    try:
+        for concert in insert_shows(concerts):
+            print('New concert: {}'.format(concert))
+        with metrics.stage('commit'):
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        response_cache.discard()
+        row_fingerprints.discard()
+        raise
+    with metrics.stage('save_state'):
+        response_cache.save()
+        row_fingerprints.save()
+        scheduler.save()
+    if app.config['STATIC_SITE_DIR']:
+        with metrics.stage('publish'):
+            publish(app.config['STATIC_SITE_DIR'])
+    metrics.emit(SCRAPER_METRICS_FILE)
 
 if __name__ == '__main__':
     main()
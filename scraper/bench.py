@@ -0,0 +1,271 @@
+"""Benchmarks for the calendar scrapers
+
+Run with `python -m scraper.bench suite` to measure throughput and peak
+memory, or `python -m scraper.bench parsers` to compare parser backends.
+Calendars are built from the test fixtures, so no network access is needed.
+"""
+
+import argparse
+import datetime
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from unittest import mock
+
+import os
+from bs4 import FeatureNotFound
+
+import scraper
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+fixtures = os.path.join(basedir, 'tests')
+
+PARSERS = ['html.parser', 'lxml', 'html5lib']
+
+# Stands in for the navigation and sidebars around a real calendar
+PAGE_FILLER = '<div class="sidebar">{}</div>'.format(
+    ''.join('<p><a href="/page/{0}">Link {0}</a></p>'.format(i) for i in range(200)))
+
+
+def _fixture(name):
+    with open(os.path.join(fixtures, name)) as f:
+        return f.read()
+
+
+def chapel_calendar(shows):
+    """
+    Returns a Chapel calendar page of shows copies of the fixture show, one per day
+    """
+    show = _fixture('chapel_test_show.html')
+    days = []
+    for i in range(shows):
+        day = '<div class="vevent"><span class="value-title" title="2016-{:02d}-{:02d}T20:00:00"></span>{}</div>'
+        days.append(day.format(i // 28 % 12 + 1, i % 28 + 1, show.replace('Diane Coffee', 'Diane Coffee {}'.format(i))))
+    return '<html><body>{0}{1}{0}</body></html>'.format(PAGE_FILLER, ''.join(days))
+
+
+def both_calendar(shows):
+    """
+    Returns a Bottom of the Hill calendar page of shows copies of the fixture show
+    """
+    show = _fixture('both_test_show.html')
+    rows = [show.replace('>Turnover<', '>Turnover {}<'.format(i)) for i in range(shows)]
+    return '<html><body>{0}<table id="listings">{1}</table>{0}</body></html>'.format(PAGE_FILLER, ''.join(rows))
+
+
+@contextmanager
+def stub_calendar(markup, parser='html.parser', strain=True):
+    """
+    Serve markup in place of every fetched calendar, parsed with parser,
+    parse every row regardless of fingerprints and silence the scrapers'
+    printing
+    """
+    def get_soup(url, parse_only=None):
+        return scraper._make_soup(markup, parse_only if strain else None)
+
+    with mock.patch.object(scraper, 'SCRAPER_PARSER', parser), \
+            mock.patch.object(scraper, 'SCRAPER_FORCE_PARSE', True), \
+            mock.patch.object(scraper, '_get_soup', get_soup), \
+            redirect_stdout(io.StringIO()):
+        yield
+
+
+def available_parsers():
+    parsers = []
+    for parser in PARSERS:
+        try:
+            scraper.BeautifulSoup('', parser)
+        except FeatureNotFound:
+            continue
+        parsers.append(parser)
+    return parsers
+
+
+def compare_parsers(shows=200):
+    """
+    Time chapel() and both() with each available parser, with and without
+    their SoupStrainer, and check the output matches a full html.parser tree.
+    Returns a list of result dicts.
+    """
+    results = []
+    for scrape, calendar in [(scraper.chapel, chapel_calendar), (scraper.both, both_calendar)]:
+        markup = calendar(shows)
+        with stub_calendar(markup, strain=False):
+            expected = scrape()
+        for parser in available_parsers():
+            for strain in (False, True):
+                with stub_calendar(markup, parser, strain):
+                    started = time.perf_counter()
+                    output = scrape()
+                    elapsed = time.perf_counter() - started
+                results.append({'scraper': scrape.__name__,
+                                'parser': parser,
+                                'strained': strain,
+                                'seconds': elapsed,
+                                'same_output': output == expected})
+    return results
+
+
+def _chapel_shows(markup):
+    """
+    Returns the (date, show) pairs parse_chapel is called with for a calendar
+    """
+    soup = scraper._make_soup(markup, scraper.CHAPEL_STRAINER)
+    shows = []
+    for day in soup.findAll(class_='vevent'):
+        show_date = datetime.datetime.strptime(day.find('span', class_='value-title').get('title')[:10],
+                                               '%Y-%m-%d')
+        shows.extend((show_date, show) for show in day.findAll('div', class_='one-event'))
+    return shows
+
+
+def _both_shows(markup):
+    """
+    Returns the rows parse_both is called with for a calendar
+    """
+    soup = scraper._make_soup(markup, scraper.BOTH_STRAINER)
+    return [row for row in soup.find('table', id='listings').findAll('tr') if row.find(class_='date')]
+
+
+def benchmarks(shows):
+    """
+    Returns (name, function) pairs, each function processing shows shows
+    """
+    chapel_markup = chapel_calendar(shows)
+    both_markup = both_calendar(shows)
+    chapel_shows = _chapel_shows(chapel_markup)
+    both_shows = _both_shows(both_markup)
+
+    def run_chapel():
+        with stub_calendar(chapel_markup, scraper.SCRAPER_PARSER):
+            scraper.chapel()
+
+    def run_both():
+        with stub_calendar(both_markup, scraper.SCRAPER_PARSER):
+            scraper.both()
+
+    def run_parse_chapel():
+        with redirect_stdout(io.StringIO()):
+            for show_date, show in chapel_shows:
+                scraper.parse_chapel(show_date, show)
+
+    def run_parse_both():
+        with redirect_stdout(io.StringIO()):
+            for show in both_shows:
+                scraper.parse_both(show)
+
+    return [('chapel', run_chapel),
+            ('both', run_both),
+            ('parse_chapel', run_parse_chapel),
+            ('parse_both', run_parse_both)]
+
+
+def measure(func, shows, repeat=3):
+    """
+    Returns the best time of repeat runs of func and its peak traced memory
+    """
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'shows': shows,
+            'seconds': min(seconds),
+            'shows_per_second': shows / min(seconds),
+            'peak_bytes': peak_bytes}
+
+
+def run_suite(sizes=(100, 1000), repeat=3):
+    """
+    Run every benchmark at each calendar size.
+    Returns results keyed by "<benchmark>@<shows>".
+    """
+    results = {}
+    for shows in sizes:
+        for name, func in benchmarks(shows):
+            results['{}@{}'.format(name, shows)] = measure(func, shows, repeat)
+    return {'meta': {'python': platform.python_version(),
+                     'parser': scraper.SCRAPER_PARSER,
+                     'created': datetime.datetime.utcnow().isoformat()},
+            'results': results}
+
+
+def compare(run, baseline, tolerance=0.25):
+    """
+    Returns a message for every benchmark in both runs whose throughput fell,
+    or peak memory grew, by more than tolerance relative to baseline
+    """
+    regressions = []
+    for name, result in sorted(run['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        if result['shows_per_second'] < base['shows_per_second'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} shows/s, baseline {:.0f}'.format(
+                name, result['shows_per_second'], base['shows_per_second']))
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance):
+            regressions.append('{}: peak {} bytes, baseline {}'.format(
+                name, result['peak_bytes'], base['peak_bytes']))
+    return regressions
+
+
+def suite(args):
+    run = run_suite(args.sizes, args.repeat)
+    for name, result in sorted(run['results'].items()):
+        print('{:20} {:10.0f} shows/s {:12} peak bytes'.format(
+            name, result['shows_per_second'], result['peak_bytes']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(run, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+def parsers(args):
+    for result in compare_parsers(args.shows):
+        print('{scraper:8} {parser:12} {strain:9} {seconds:8.3f}s  {same}'.format(
+            strain='strained' if result['strained'] else 'full',
+            same='same output' if result['same_output'] else 'OUTPUT DIFFERS',
+            **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    suite_parser = subparsers.add_parser('suite', help='measure throughput and peak memory')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                              help='shows per synthetic calendar')
+    suite_parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark')
+    suite_parser.add_argument('--output', help='write results to this JSON file')
+    suite_parser.add_argument('--baseline', help='compare against this JSON results file')
+    suite_parser.add_argument('--tolerance', type=float, default=0.25,
+                              help='allowed fractional regression before failing')
+    suite_parser.set_defaults(func=suite)
+
+    parsers_parser = subparsers.add_parser('parsers', help='compare parser backends')
+    parsers_parser.add_argument('--shows', type=int, default=200, help='shows per synthetic calendar')
+    parsers_parser.set_defaults(func=parsers)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""On-disk cache of calendar responses for conditional GETs"""
+
+import hashlib
+import json
+import threading
+import time
+
+import os
+
+
+class ResponseCache(object):
+    """
+    Stores the last body of each calendar url along with its ETag/Last-Modified
+    validators and a hash of the body. Bodies are evicted least recently used
+    first once they take up more than max_bytes.
+
+    Responses passed to store() are only staged. save() writes them to disk
+    and the index, so call it once the scraped shows are committed, and call
+    discard() when they are not: a failed run then refetches everything,
+    even in a process that stays alive for the next run.
+    """
+
+    def __init__(self, path, max_bytes=20 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(path, 'index.json')
+        self._lock = threading.Lock()
+        self._index = None
+        self._pending = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except (IOError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _body_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+
+    def validators(self, url):
+        """
+        Return the conditional request headers for url
+        """
+        with self._lock:
+            entry = self.index.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def body(self, url):
+        """
+        Return the saved body of url, or None
+        """
+        try:
+            with open(self._body_path(url), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def store(self, url, resp):
+        """
+        Stage a response for url until save().
+        Returns False if the page is unchanged since it was last saved.
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if resp.status_code == 304:
+                if entry:
+                    self._pending[url] = (dict(entry, used=time.time()), None)
+                return entry is None
+            digest = hashlib.sha1(resp.content).hexdigest()
+            changed = entry is None or entry['sha1'] != digest
+            self._pending[url] = ({'etag': resp.headers.get('ETag'),
+                                   'last_modified': resp.headers.get('Last-Modified'),
+                                   'sha1': digest,
+                                   'size': len(resp.content),
+                                   'used': time.time()},
+                                  resp.content if changed else None)
+            return changed
+
+    def discard(self):
+        """
+        Drop the responses staged since the last save()
+        """
+        with self._lock:
+            self._pending = {}
+
+    def save(self):
+        """
+        Write the staged responses, evict bodies over max_bytes and write the
+        index to disk
+        """
+        with self._lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            for url, (entry, content) in self._pending.items():
+                if content is not None:
+                    with open(self._body_path(url), 'wb') as f:
+                        f.write(content)
+                self.index[url] = entry
+            self._pending = {}
+            total = sum(entry['size'] for entry in self.index.values())
+            for url, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+                if total <= self.max_bytes:
+                    break
+                total -= entry['size']
+                del self.index[url]
+                try:
+                    os.remove(self._body_path(url))
+                except OSError:
+                    pass
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+
+
+class RowFingerprints(object):
+    """
+    Stores a hash of each raw show fragment scraped from each venue's
+    calendar, so rows unchanged since the last run can skip parsing and the
+    database.
+
+    Like ResponseCache, the fingerprints seen this run only replace the
+    stored ones on save(), so call it once the scraped shows are committed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fingerprints = None
+        self._pending = {}
+
+    @property
+    def fingerprints(self):
+        if self._fingerprints is None:
+            try:
+                with open(self.path) as f:
+                    self._fingerprints = json.load(f)
+            except (IOError, ValueError):
+                self._fingerprints = {}
+        return self._fingerprints
+
+    @staticmethod
+    def fingerprint(*parts):
+        return hashlib.sha1(''.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def seen(self, venue):
+        """
+        Return the set of fingerprints stored for venue
+        """
+        with self._lock:
+            return set(self.fingerprints.get(venue, ()))
+
+    def update(self, venue, fingerprints):
+        """
+        Replace venue's fingerprints with those on its calendar this run
+        """
+        with self._lock:
+            self._pending[venue] = sorted(fingerprints)
+
+    def discard(self):
+        """
+        Drop the fingerprints updated since the last save()
+        """
+        with self._lock:
+            self._pending = {}
+
+    def save(self):
+        with self._lock:
+            self.fingerprints.update(self._pending)
+            self._pending = {}
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.fingerprints, f)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,100 @@
+"""Per-stage and per-venue timings and counts for a scrape run"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class RunMetrics(object):
+    """
+    Collects stage durations and counters for one run. Stages and counters
+    recorded inside venue() are attributed to that venue as well, so venue
+    scrapers running in threads each get their own numbers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.start()
+
+    def start(self):
+        """
+        Clear the metrics and restart the run clock
+        """
+        with self._lock:
+            self.started = time.time()
+            self.stages = defaultdict(float)
+            self.counters = defaultdict(int)
+            self.venues = {}
+
+    def _venue(self):
+        name = getattr(self._local, 'venue', None)
+        if name is None:
+            return None
+        return self.venues.setdefault(name, {'seconds': 0.0,
+                                             'stages': defaultdict(float),
+                                             'counters': defaultdict(int)})
+
+    @contextmanager
+    def venue(self, name):
+        """
+        Attribute what this thread records to venue name
+        """
+        self._local.venue = name
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._venue()['seconds'] += time.time() - started
+            self._local.venue = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Add the time spent in the block to stage name
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                self.stages[name] += elapsed
+                venue = self._venue()
+                if venue is not None:
+                    venue['stages'][name] += elapsed
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+            venue = self._venue()
+            if venue is not None:
+                venue['counters'][name] += count
+
+    def record(self):
+        """
+        Returns the run's metrics as a JSON serialisable dict
+        """
+        with self._lock:
+            return {'started': self.started,
+                    'seconds': time.time() - self.started,
+                    'stages': dict(self.stages),
+                    'counters': dict(self.counters),
+                    'venues': dict((name, {'seconds': venue['seconds'],
+                                           'stages': dict(venue['stages']),
+                                           'counters': dict(venue['counters'])})
+                                   for name, venue in self.venues.items())}
+
+    def emit(self, path=None):
+        """
+        Print the run's record as one line of JSON, appending it to path too
+        if given
+        """
+        line = json.dumps(self.record(), sort_keys=True)
+        print(line)
+        if path:
+            with open(path, 'a') as f:
+                f.write(line + '\n')
@@ -0,0 +1,81 @@
+"""Adaptive per-venue scrape scheduling"""
+
+import json
+import time
+
+import os
+
+
+class ScrapeScheduler(object):
+    """
+    Decides which venues are due for a scrape.
+
+    Each venue's interval halves (down to its min_interval) when its calendar
+    changed and doubles (up to its max_interval) when it did not, so busy
+    venues are scraped often and quiet ones rarely. Venues are due once 90% of
+    their interval has passed, leaving slack for cron jitter. State is kept
+    in a JSON file and written by save().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._state = None
+
+    @property
+    def state(self):
+        if self._state is None:
+            try:
+                with open(self.path) as f:
+                    self._state = json.load(f)
+            except (IOError, ValueError):
+                self._state = {}
+        return self._state
+
+    def reload(self):
+        """
+        Forget the loaded state, so it is read again on next use
+        """
+        self._state = None
+
+    def due(self, venues, now=None, force=False):
+        """
+        Returns the venues due for a scrape, most overdue first
+        """
+        now = now or time.time()
+        overdue = []
+        for venue in venues:
+            venue_state = self.state.get(venue.name)
+            if venue_state is None or force:
+                overdue.append((float('inf'), venue))
+                continue
+            elapsed = now - venue_state['last_scraped']
+            if elapsed >= venue_state['interval'] * 0.9:
+                overdue.append((elapsed / venue_state['interval'], venue))
+        overdue.sort(key=lambda item: item[0], reverse=True)
+        return [venue for _, venue in overdue]
+
+    def record(self, venue, changed, now=None):
+        """
+        Record a finished scrape of venue and adjust its interval
+        """
+        now = now or time.time()
+        venue_state = self.state.setdefault(venue.name, {'interval': venue.min_interval,
+                                                         'runs': 0,
+                                                         'changes': 0})
+        venue_state['runs'] += 1
+        venue_state['last_scraped'] = now
+        if changed:
+            venue_state['changes'] += 1
+            venue_state['last_changed'] = now
+            venue_state['interval'] = max(venue.min_interval, venue_state['interval'] / 2)
+        else:
+            venue_state['interval'] = min(venue.max_interval, venue_state['interval'] * 2)
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
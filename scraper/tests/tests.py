@@ -1,8 +1,22 @@
 import unittest
 import datetime
+import json
 import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import requests
 from bs4 import BeautifulSoup
 import scraper
+from scraper import bench
+from radradrad import app, db, Artist, Concert, ConcertArtist, DailyAdded
+from radradrad.search import search_concerts
+from scraper.cache import ResponseCache, RowFingerprints
+from scraper.metrics import RunMetrics
+from scraper.schedule import ScrapeScheduler
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -52,3 +66,364 @@ class BottomOfTheHillTestCase(unittest.TestCase):
                            'show_url':
                            'http://www.bottomofthehill.com/20160824.html'}
         self.assertEqual(parsed_show, expected_output)
+
+
+class ScrapeVenuesTestCase(unittest.TestCase):
+
+    def test_scrape_venues_keeps_venue_order(self):
+        def slow():
+            time.sleep(0.1)
+            return ['slow']
+
+        def fast():
+            return ['fast']
+
+        venues = [scraper.VenueScraper('Slow', None, slow, 60, 600),
+                  scraper.VenueScraper('Fast', None, fast, 60, 600)]
+        self.assertEqual(scraper.scrape_venues(venues, workers=2),
+                         OrderedDict([('Slow', ['slow']), ('Fast', ['fast'])]))
+
+    def test_scrape_venues_skips_venues_over_budget(self):
+        def slow():
+            time.sleep(0.1)
+            return ['slow']
+
+        venues = [scraper.VenueScraper('Slow', None, slow, 60, 600),
+                  scraper.VenueScraper('Late', None, lambda: ['late'], 60, 600)]
+        self.assertEqual(scraper.scrape_venues(venues, workers=1, budget=0.05),
+                         OrderedDict([('Slow', ['slow'])]))
+
+    def test_scrape_venues_leaves_out_timed_out_venues(self):
+        venues = [scraper.VenueScraper('The Chapel', 'http://www.thechapelsf.com/calendar/', scraper.chapel, 60, 600),
+                  scraper.VenueScraper('Fast', None, lambda: ['fast'], 60, 600)]
+        scraper.metrics.start()
+        with mock.patch.object(scraper.session, 'get', side_effect=requests.Timeout) as get, \
+                mock.patch('builtins.print'):
+            self.assertEqual(scraper.scrape_venues(venues), OrderedDict([('Fast', ['fast'])]))
+        self.assertEqual(get.call_args[1]['timeout'], scraper.SCRAPER_HTTP_TIMEOUT)
+        self.assertEqual(scraper.metrics.counters['venues_failed'], 1)
+
+    def test_venues_are_registered(self):
+        self.assertEqual(list(scraper.venue_scrapers), ['The Chapel', 'Bottom of the Hill'])
+        self.assertIs(scraper.venue_scrapers['The Chapel'].scrape, scraper.chapel)
+
+
+class ScrapeSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.scheduler = ScrapeScheduler(os.path.join(self.dir, 'schedule.json'))
+        self.busy = scraper.VenueScraper('Busy', None, None, 60, 3600)
+        self.quiet = scraper.VenueScraper('Quiet', None, None, 60, 3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_new_venues_are_due(self):
+        self.assertEqual(self.scheduler.due([self.busy, self.quiet], now=1000), [self.busy, self.quiet])
+
+    def test_interval_adapts_to_changes(self):
+        for i in range(4):
+            self.scheduler.record(self.busy, changed=True, now=1000)
+            self.scheduler.record(self.quiet, changed=False, now=1000)
+        self.assertEqual(self.scheduler.state['Busy']['interval'], 60)
+        self.assertEqual(self.scheduler.state['Quiet']['interval'], 960)
+        self.assertEqual(self.scheduler.due([self.busy, self.quiet], now=1100), [self.busy])
+        self.assertEqual(self.scheduler.due([self.busy, self.quiet], now=2000), [self.busy, self.quiet])
+        self.assertEqual(self.scheduler.due([self.busy, self.quiet], now=1000, force=True),
+                         [self.busy, self.quiet])
+
+    def test_state_survives_save(self):
+        self.scheduler.record(self.quiet, changed=False, now=1000)
+        self.scheduler.save()
+        scheduler = ScrapeScheduler(self.scheduler.path)
+        self.assertEqual(scheduler.state['Quiet']['interval'], 120)
+        self.assertEqual(scheduler.due([self.quiet], now=1050), [])
+
+
+class FakeResponse(object):
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.path, max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store_returns_validators(self):
+        self.cache.store('http://a', FakeResponse(b'abc', headers={'ETag': '"1"'}))
+        self.assertEqual(self.cache.validators('http://a'), {})
+        self.cache.save()
+        self.assertEqual(self.cache.validators('http://a'), {'If-None-Match': '"1"'})
+
+    def test_store_detects_unchanged_body(self):
+        self.assertTrue(self.cache.store('http://a', FakeResponse(b'abc')))
+        self.cache.save()
+        self.assertFalse(self.cache.store('http://a', FakeResponse(b'abc')))
+        self.assertFalse(self.cache.store('http://a', FakeResponse(b'', status_code=304)))
+        self.assertTrue(self.cache.store('http://a', FakeResponse(b'abcd')))
+
+    def test_discard_forgets_staged_responses(self):
+        self.cache.store('http://a', FakeResponse(b'abc', headers={'ETag': '"1"'}))
+        self.cache.discard()
+        self.cache.save()
+        self.assertEqual(self.cache.validators('http://a'), {})
+        self.assertTrue(self.cache.store('http://a', FakeResponse(b'abc')))
+
+    def test_save_persists_index(self):
+        self.cache.store('http://a', FakeResponse(b'abc', headers={'ETag': '"1"'}))
+        self.cache.save()
+        cache = ResponseCache(self.path)
+        self.assertEqual(cache.validators('http://a'), {'If-None-Match': '"1"'})
+        self.assertEqual(cache.body('http://a'), b'abc')
+
+    def test_save_evicts_least_recently_used(self):
+        self.cache.store('http://a', FakeResponse(b'123456'))
+        self.cache.store('http://b', FakeResponse(b'123456'))
+        self.cache.save()
+        self.assertNotIn('http://a', self.cache.index)
+        self.assertIsNone(self.cache.body('http://a'))
+        self.assertEqual(self.cache.body('http://b'), b'123456')
+
+    def test_get_soup_skips_unchanged_calendar(self):
+        with mock.patch.object(scraper, 'response_cache', self.cache), \
+                mock.patch.object(scraper.session, 'get', return_value=FakeResponse(b'<p>hi</p>')):
+            self.assertIsNotNone(scraper._get_soup('http://a'))
+            self.cache.save()
+            self.assertIsNone(scraper._get_soup('http://a'))
+
+    def test_get_soup_refetches_not_modified_calendar_without_body(self):
+        responses = [FakeResponse(b'', status_code=304), FakeResponse(b'<p>hi</p>')]
+        with mock.patch.object(scraper, 'response_cache', self.cache), \
+                mock.patch.object(scraper.session, 'get', side_effect=responses) as get:
+            self.assertEqual(scraper._get_soup('http://a').get_text(), 'hi')
+        self.assertEqual(get.call_args_list[1], mock.call('http://a', timeout=scraper.SCRAPER_HTTP_TIMEOUT))
+
+
+class InsertShowsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+        scraper.init_db()
+        self.show = {'show_date': datetime.datetime(2016, 8, 24),
+                     'show_time': '8:00PM',
+                     'show_url': 'http://www.bottomofthehill.com/20160824.html',
+                     'show_headliner': 'Turnover',
+                     'show_supports': ['Angel Dust', 'Triathalon'],
+                     'show_location': 'Bottom of the Hill',
+                     'show_age': 'ALL AGES',
+                     'show_cost': '$15'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        os.unlink(os.path.join(basedir, 'test.db'))
+
+    def test_insert_shows_returns_new_shows(self):
+        other = dict(self.show, show_headliner='Angel Dust')
+        self.assertEqual(scraper.insert_shows([self.show, other, dict(self.show)]), [self.show, other])
+        db.session.commit()
+        self.assertEqual(Concert.query.count(), 2)
+        self.assertEqual(DailyAdded.today(), 2)
+
+    def test_insert_shows_skips_existing_shows(self):
+        scraper.insert_shows([self.show])
+        db.session.commit()
+        self.assertEqual(scraper.insert_shows([dict(self.show)]), [])
+
+    def test_insert_shows_skips_near_duplicates(self):
+        scraper.insert_shows([dict(self.show, show_headliner='TBA')])
+        db.session.commit()
+        shows = [dict(self.show, show_headliner='tba '), dict(self.show), dict(self.show, show_headliner='TURNOVER')]
+        self.assertEqual(scraper.insert_shows(shows), [self.show])
+        db.session.commit()
+        self.assertEqual(sorted(concert.headliner for concert in Concert.query), ['TBA', 'Turnover'])
+
+    def test_insert_shows_sets_venue(self):
+        scraper.insert_shows([self.show])
+        db.session.commit()
+        concert = Concert.query.one()
+        self.assertEqual(concert.venue.name, 'Bottom of the Hill')
+        self.assertEqual(concert.supports, 'Angel Dust,Triathalon')
+        self.assertEqual(concert.date, datetime.date(2016, 8, 24))
+        self.assertEqual(concert.starts_at, int(datetime.datetime(2016, 8, 24, 20).timestamp()))
+        self.assertIsNotNone(concert.created_at)
+
+    def test_insert_shows_links_artists(self):
+        scraper.insert_shows([self.show, dict(self.show, show_headliner='Angel Dust', show_supports=None)])
+        db.session.commit()
+        concert = Concert.query.filter(Concert.headliner == 'Turnover').one()
+        lineup = db.session.query(ConcertArtist.position, Artist.name) \
+            .join(Artist, Artist.id == ConcertArtist.artist_id) \
+            .filter(ConcertArtist.concert_id == concert.id).order_by(ConcertArtist.position).all()
+        self.assertEqual(lineup, [(0, 'Turnover'), (1, 'Angel Dust'), (2, 'Triathalon')])
+        self.assertEqual(Artist.query.count(), 3)
+
+    def test_insert_shows_updates_search_index(self):
+        scraper.insert_shows([self.show])
+        db.session.commit()
+        concerts, _ = search_concerts('triathalon')
+        self.assertEqual([concert.headliner for concert in concerts], ['Turnover'])
+
+    def test_insert_shows_counts_new_and_duplicate_shows(self):
+        scraper.metrics.start()
+        scraper.insert_shows([self.show, dict(self.show)])
+        counters = scraper.metrics.record()['counters']
+        self.assertEqual(counters['shows_new'], 1)
+        self.assertEqual(counters['shows_duplicate'], 1)
+        self.assertGreaterEqual(counters['db_round_trips'], 2)
+        self.assertIn('insert', scraper.metrics.record()['stages'])
+        round_trips = counters['db_round_trips']
+        Concert.query.all()
+        self.assertEqual(scraper.metrics.record()['counters']['db_round_trips'], round_trips)
+
+
+class RunMetricsTestCase(unittest.TestCase):
+
+    def test_venue_threads_get_their_own_metrics(self):
+        metrics = RunMetrics()
+
+        def scrape(name):
+            with metrics.venue(name), metrics.stage('parse'):
+                metrics.add('shows_parsed', len(name))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(scrape, ['ab', 'abc']))
+        metrics.add('shows_new', 4)
+        record = json.loads(json.dumps(metrics.record()))
+        self.assertEqual(record['counters'], {'shows_parsed': 5, 'shows_new': 4})
+        self.assertEqual(record['venues']['abc']['counters'], {'shows_parsed': 3})
+        self.assertIn('parse', record['venues']['ab']['stages'])
+        self.assertEqual(sorted(record['stages']), ['parse'])
+
+    def test_scraping_records_venue_metrics(self):
+        scraper.metrics.start()
+        venues = [scraper.VenueScraper('The Chapel', None, scraper.chapel, 60, 600)]
+        with bench.stub_calendar(bench.chapel_calendar(3)):
+            scraper.scrape_venues(venues)
+        venue = scraper.metrics.record()['venues']['The Chapel']
+        self.assertEqual(venue['counters']['shows_parsed'], 3)
+        self.assertIn('parse', venue['stages'])
+
+    def test_emit_appends_a_json_line(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'metrics.jsonl')
+        metrics = RunMetrics()
+        with mock.patch('builtins.print'):
+            metrics.emit(path)
+            metrics.emit(path)
+        with open(path) as f:
+            self.assertEqual(len([json.loads(line) for line in f]), 2)
+
+
+class RowFingerprintsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fingerprints = RowFingerprints(os.path.join(self.dir, 'fingerprints.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scrape(self, scrape, markup):
+        def get_soup(url, parse_only=None):
+            return scraper._make_soup(markup, parse_only)
+
+        with mock.patch.object(scraper, 'row_fingerprints', self.fingerprints), \
+                mock.patch.object(scraper, '_get_soup', get_soup), \
+                mock.patch('builtins.print'):
+            return scrape()
+
+    def test_unchanged_rows_are_skipped_after_save(self):
+        markup = bench.chapel_calendar(5)
+        self.assertEqual(len(self.scrape(scraper.chapel, markup)), 5)
+        self.assertEqual(len(self.scrape(scraper.chapel, markup)), 5)
+        self.fingerprints.save()
+        self.assertEqual(self.scrape(scraper.chapel, markup), [])
+        changed = self.scrape(scraper.chapel, markup.replace('Diane Coffee 3<', 'Diane Coffee Three<'))
+        self.assertEqual([show['show_headliner'] for show in changed], ['Diane Coffee Three'])
+
+    def test_discarded_rows_are_parsed_again(self):
+        markup = bench.chapel_calendar(5)
+        self.scrape(scraper.chapel, markup)
+        self.fingerprints.discard()
+        self.fingerprints.save()
+        self.assertEqual(len(self.scrape(scraper.chapel, markup)), 5)
+
+    def test_fingerprints_follow_the_calendar(self):
+        self.scrape(scraper.both, bench.both_calendar(5))
+        self.fingerprints.save()
+        self.scrape(scraper.both, bench.both_calendar(2))
+        self.fingerprints.save()
+        fingerprints = RowFingerprints(self.fingerprints.path)
+        self.assertEqual(len(fingerprints.seen('Bottom of the Hill')), 2)
+        self.assertEqual(len(self.scrape(scraper.both, bench.both_calendar(3))), 1)
+
+
+class ParserBackendTestCase(unittest.TestCase):
+
+    def test_strained_parsers_match_full_tree(self):
+        for result in bench.compare_parsers(shows=5):
+            self.assertTrue(result['same_output'], result)
+
+    def test_synthetic_calendars_parse_every_show(self):
+        with bench.stub_calendar(bench.chapel_calendar(5)):
+            self.assertEqual(len(scraper.chapel()), 5)
+        with bench.stub_calendar(bench.both_calendar(5)):
+            self.assertEqual(len(scraper.both()), 5)
+
+
+class ParseRowsTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        scraper.shutdown_parse_pool()
+
+    def test_process_pool_matches_serial_parsing(self):
+        for markup, rows, parse, parse_html in [
+                (bench.chapel_calendar(20), bench._chapel_shows, scraper.parse_chapel, scraper._parse_chapel_html),
+                (bench.both_calendar(20), bench._both_shows, scraper.parse_both, scraper._parse_both_html)]:
+            rows = [row if isinstance(row, tuple) else (row,) for row in rows(markup)]
+            with mock.patch('builtins.print'):
+                serial = scraper.parse_rows(rows, parse, parse_html, processes=0)
+                with mock.patch.object(scraper, 'SCRAPER_PARSE_POOL_MIN_ROWS', 10):
+                    pooled = scraper.parse_rows(rows, parse, parse_html, processes=2)
+            self.assertEqual(len(serial), 20)
+            self.assertEqual(pooled, serial)
+
+    def test_pool_workers_are_not_forked(self):
+        self.assertNotEqual(scraper._get_parse_pool(2)._mp_context.get_start_method(), 'fork')
+
+    def test_small_calendars_are_parsed_serially(self):
+        rows = [(row,) for row in bench._both_shows(bench.both_calendar(3))]
+        with mock.patch.object(scraper, '_get_parse_pool') as get_parse_pool, mock.patch('builtins.print'):
+            self.assertEqual(len(scraper.parse_rows(rows, scraper.parse_both, scraper._parse_both_html,
+                                                    processes=2)), 3)
+        get_parse_pool.assert_not_called()
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_run_suite_reports_every_benchmark(self):
+        run = bench.run_suite(sizes=[3], repeat=1)
+        self.assertEqual(sorted(run['results']),
+                         ['both@3', 'chapel@3', 'parse_both@3', 'parse_chapel@3'])
+        for result in run['results'].values():
+            self.assertGreater(result['shows_per_second'], 0)
+            self.assertGreater(result['peak_bytes'], 0)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'results': {'chapel@3': {'shows_per_second': 100, 'peak_bytes': 1000}}}
+        run = {'results': {'chapel@3': {'shows_per_second': 90, 'peak_bytes': 1100}}}
+        self.assertEqual(bench.compare(run, baseline), [])
+        run = {'results': {'chapel@3': {'shows_per_second': 50, 'peak_bytes': 2000}}}
+        self.assertEqual(len(bench.compare(run, baseline)), 2)